@@ -0,0 +1,312 @@
+let s:plugin_root_dir = fnamemodify(resolve(expand('<sfile>:p')), ':h:h') . '/plugin'
+
+" Python is only loaded the first time a buffer actually needs it
+let s:python_loaded = 0
+
+function s:ensure_python()
+    if s:python_loaded
+        return
+    endif
+    let s:python_loaded = 1
+
+python3 << EOF
+import sys
+import vim
+plugin_root_dir = vim.eval('s:plugin_root_dir')
+sys.path.insert(0, plugin_root_dir)
+import docstring
+EOF
+
+    " Uploads still in flight on exit are spooled, to be done next time
+    augroup docstring_spool
+        autocmd!
+        autocmd VimLeavePre * python3 docstring.spool_pending()
+    augroup END
+endfunction
+
+" Loading Python starts uploading whatever was spooled in an earlier session
+function! docstring#resume_uploads()
+    call s:ensure_python()
+endfunction
+
+" Marks the top line of each docs template being generated, so tokens still
+" land in the right place if lines are added or removed while they stream in
+if has('textprop') && empty(prop_type_get('docstring_doc'))
+    call prop_type_add('docstring_doc', {})
+endif
+
+function s:docgen_cb(channel, msg)
+    " Any output means the proxy managed to connect, so it's worth restarting if it dies
+    let s:proxy_healthy = 1
+    python3 docstring.docgen_cb()
+endfunction
+
+" A single generation proxy runs for the whole session and multiplexes
+" every :UpdateDocstring over one websocket. It is started on first use.
+let s:proxy_job = v:null
+let s:proxy_healthy = 0
+let s:proxy_restart_delay = 500
+
+function s:proxy_start()
+    let env = {'API_KEY': g:docstring_api_key}
+    if exists('g:docstring_max_generations')
+        let env.DOCSTRING_MAX_GENERATIONS = string(g:docstring_max_generations)
+    endif
+    if exists('g:docstring_idle_timeout')
+        let env.DOCSTRING_IDLE_TIMEOUT = string(g:docstring_idle_timeout)
+    endif
+    if get(g:, 'docstring_stats', 0) || get(g:, 'docstring_trace_file', '') !=# ''
+        " The proxy then reports its timings as "stats" messages
+        let env.DOCSTRING_STATS = '1'
+    endif
+
+    let s:proxy_healthy = 0
+    let s:proxy_job = job_start(["/usr/bin/python3", s:plugin_root_dir . "/docstring_proxy.py", "--serve"], {
+                \ 'out_cb': function('s:docgen_cb'),
+                \ 'exit_cb': function('s:proxy_exit_cb'),
+                \ 'env': env
+                \ })
+endfunction
+
+function s:proxy_exit_cb(job, status)
+    let s:proxy_job = v:null
+    if s:python_loaded
+        python3 docstring.abandon_generations()
+    endif
+
+    " Only restart a proxy that had been working, so a bad key or being offline
+    " doesn't turn into a restart loop. Otherwise the next request starts it.
+    if !s:proxy_healthy
+        return
+    endif
+
+    call timer_start(s:proxy_restart_delay, {-> s:proxy_ensure()})
+    let s:proxy_restart_delay = min([s:proxy_restart_delay * 2, 30000])
+endfunction
+
+function s:proxy_ensure()
+    if s:proxy_job is v:null || job_status(s:proxy_job) !=# 'run'
+        call s:proxy_start()
+    endif
+endfunction
+
+" Generates docs for a buffer, the current one by default. The proxy runs up to
+" g:docstring_max_generations of them at once and queues the rest. Only scopes
+" whose code changed since docs were last generated get them, unless full is set.
+function! docstring#update(...)
+    let bufnr = a:0 ? a:1 : bufnr('%')
+    let full = a:0 > 1 && a:2 ? 'True' : 'False'
+
+    call s:ensure_python()
+    call s:proxy_ensure()
+    call ch_sendraw(s:proxy_job, py3eval('docstring.generation_request(' . bufnr . ', ' . full . ')'))
+endfunction
+
+function! docstring#update_all_complete(lead, line, pos)
+    return filter(['args', 'quickfix'], {_, source -> source =~# '^' . a:lead})
+endfunction
+
+" Generates docs for every file in the argument list, or in the quickfix list
+function! docstring#update_all(...)
+    let source = a:0 && a:1 !=# '' ? a:1 : 'args'
+    let full = a:0 > 1 && a:2
+    if source ==# 'args'
+        let bufnrs = map(argv(), {_, name -> bufadd(fnamemodify(name, ':p'))})
+    elseif source ==# 'quickfix'
+        let bufnrs = map(filter(getqflist(), {_, entry -> entry.bufnr > 0}), {_, entry -> entry.bufnr})
+    else
+        echoerr 'Docstring: Expected "args" or "quickfix", got ' . source
+        return
+    endif
+
+    let seen = {}
+    for bufnr in bufnrs
+        if has_key(seen, bufnr)
+            continue
+        endif
+        let seen[bufnr] = 1
+
+        " Docs are inserted into the buffer, so it has to be loaded, not necessarily shown
+        call bufload(bufnr)
+        call docstring#update(bufnr, full)
+    endfor
+endfunction
+
+function! docstring#stats()
+    call s:ensure_python()
+    python3 docstring.print_stats()
+endfunction
+
+" Uploads happen on a background thread, this timer reports their results
+" and stops itself once nothing is left in flight
+let s:persist_timer = -1
+
+function s:persist_poll(timer)
+    if !py3eval('docstring.poll_persist()')
+        call timer_stop(a:timer)
+        let s:persist_timer = -1
+    endif
+endfunction
+
+function s:debug(message)
+    if get(g:, 'docstring_verbose', 0)
+        echomsg 'Docstring: ' . a:message
+    endif
+endfunction
+
+function s:matches_any(path, patterns)
+    for pattern in a:patterns
+        if a:path =~# glob2regpat(pattern)
+            return 1
+        endif
+    endfor
+    return 0
+endfunction
+
+" Returns the git directory of the repository a file is in, or '' if it isn't in one
+function s:git_dir(path)
+    let dir = escape(fnamemodify(a:path, ':h'), ' ,;*')
+
+    let dot_git = finddir('.git', dir . ';')
+    if dot_git !=# ''
+        return fnamemodify(dot_git, ':p')
+    endif
+
+    " Worktrees and submodules have a .git file pointing at their git directory
+    let dot_git = findfile('.git', dir . ';')
+    if dot_git ==# ''
+        return ''
+    endif
+    let gitdir = matchstr(get(readfile(dot_git, '', 1), 0, ''), '^gitdir: \zs.*')
+    if gitdir ==# ''
+        return ''
+    endif
+    return fnamemodify(gitdir =~# '^/' ? gitdir : fnamemodify(dot_git, ':p:h') . '/' . gitdir, ':p')
+endfunction
+
+" Whether a buffer could ever be persisted, from its type, filetype, path and repository.
+" None of that changes while editing, so it's only worked out again when the name or filetype does.
+function s:static_eligibility(path)
+    if &buftype !=# '' || a:path ==# ''
+        return 'not a file'
+    endif
+
+    let include_filetypes = get(g:, 'docstring_include_filetypes', [])
+    if !empty(include_filetypes) && index(include_filetypes, &filetype) < 0
+        return 'filetype ' . &filetype . ' not in g:docstring_include_filetypes'
+    endif
+    if index(get(g:, 'docstring_exclude_filetypes', []), &filetype) >= 0
+        return 'filetype ' . &filetype . ' in g:docstring_exclude_filetypes'
+    endif
+
+    let include_paths = get(g:, 'docstring_include_paths', [])
+    if !empty(include_paths) && !s:matches_any(a:path, include_paths)
+        return 'not in g:docstring_include_paths'
+    endif
+    if s:matches_any(a:path, get(g:, 'docstring_exclude_paths', []))
+        return 'in g:docstring_exclude_paths'
+    endif
+
+    let b:docstring_git_dir = s:git_dir(a:path)
+    if b:docstring_git_dir ==# ''
+        return 'not in a git repository'
+    endif
+
+    return ''
+endfunction
+
+" Changes whenever the files git tracks might have
+function s:index_stamp()
+    let index = b:docstring_git_dir . 'index'
+    return getftime(index) . ':' . getfsize(index)
+endfunction
+
+" Decides whether the current buffer should be persisted without entering Python
+function s:eligible()
+    let path = expand('%:p')
+
+    let key = path . "\n" . &filetype
+    if get(b:, 'docstring_eligibility_key', '') !=# key
+        let b:docstring_eligibility_key = key
+        let b:docstring_ineligible = s:static_eligibility(path)
+        unlet! b:docstring_marker_tick b:docstring_untracked_stamp
+    endif
+
+    if b:docstring_ineligible !=# ''
+        " Files outside of a repository are checked again, in case one gets created
+        if b:docstring_ineligible ==# 'not in a git repository'
+            unlet b:docstring_eligibility_key
+        endif
+        call s:debug('Not persisting file ' . path . ': ' . b:docstring_ineligible)
+        return 0
+    endif
+
+    if get(b:, 'docstring_untracked_stamp', '') ==# s:index_stamp()
+        call s:debug('Not persisting file ' . path . ': not tracked by git')
+        return 0
+    endif
+
+    if fnamemodify(path, ':t') ==? 'readme.md'
+        return 1
+    endif
+
+    " The @docstring marker is only looked for again once the buffer changed,
+    " starting with the line it was last found on
+    if get(b:, 'docstring_marker_tick', -1) != b:changedtick
+        let line = get(b:, 'docstring_marker_line', 0)
+        if line <= 0 || stridx(getline(line), '@docstring') < 0
+            let line = search('\C\V@docstring', 'cnw')
+        endif
+        let b:docstring_marker_line = line
+        let b:docstring_marker_tick = b:changedtick
+    endif
+
+    if b:docstring_marker_line <= 0
+        call s:debug('Not persisting file ' . path . ': "@docstring" not in file')
+        return 0
+    endif
+
+    return 1
+endfunction
+
+function! docstring#save()
+    if !s:eligible()
+        return
+    endif
+
+    call s:ensure_python()
+    let result = py3eval('docstring.persist()')
+    if result < 0
+        " Not tracked, which can only change with the index
+        let b:docstring_untracked_stamp = s:index_stamp()
+    elseif result > 0 && s:persist_timer == -1
+        let s:persist_timer = timer_start(200, function('s:persist_poll'), {'repeat': -1})
+    endif
+endfunction
+
+function s:sync_cb(channel, msg)
+    let progress = json_decode(a:msg)
+    if progress.type ==# 'done'
+        for error in progress.errors[:4]
+            echomsg 'Docstring: Error saving ' . error
+        endfor
+        echomsg printf('Docstring: %d uploaded, %d unchanged, %d ignored, %d failed in %.1fs',
+                    \ progress.uploaded, progress.skipped, progress.ignored, progress.failed, progress.elapsed)
+    else
+        echo printf('Docstring: Syncing %d/%d files', progress.done, progress.total)
+    endif
+endfunction
+
+" Uploads every Docstring file in the repository of the given directory,
+" or of the current file, in the background
+function! docstring#sync_repo(...)
+    let dir = a:0 && a:1 !=# '' ? fnamemodify(a:1, ':p') : expand('%:p:h')
+    if dir ==# ''
+        let dir = getcwd()
+    endif
+
+    call job_start(["/usr/bin/python3", s:plugin_root_dir . "/sync.py", "--json", dir], {
+                \ 'out_cb': function('s:sync_cb'),
+                \ 'env': {'API_KEY': g:docstring_api_key}
+                \ })
+endfunction
@@ -0,0 +1,111 @@
+"""
+Compares request latency through urllib (a new connection per request, as the
+plugin used to do) with ApiClient's kept-alive connections, against a local
+HTTP/1.1 keep-alive server. Uses TLS with a throwaway self-signed certificate
+when openssl is available, since the handshake is what keep-alive saves.
+
+    python3 bench/bench_api_client.py [requests]
+"""
+import http.server
+import json
+import pathlib
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'plugin'))
+
+from api_client import ApiClient
+
+
+class KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    # Idle connections are dropped after this long, like a real load balancer would
+    timeout = 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['content-length']))
+        body = b'{}'
+        self.send_response(200)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(tls_dir):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+    server.daemon_threads = True
+    scheme = 'http'
+    client_context = None
+
+    if tls_dir is not None:
+        cert, key = str(tls_dir / 'cert.pem'), str(tls_dir / 'key.pem')
+        subprocess.check_call([
+            'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+            '-subj', '/CN=127.0.0.1', '-keyout', key, '-out', cert,
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.load_cert_chain(cert, key)
+        server.socket = server_context.wrap_socket(server.socket, server_side=True)
+        client_context = ssl.create_default_context(cafile=cert)
+        client_context.check_hostname = False
+        scheme = 'https'
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'{scheme}://127.0.0.1:{server.server_address[1]}', client_context
+
+
+def per_request(fn, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        fn()
+    return (time.perf_counter() - start) / count * 1000
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    payload = {'content': 'x' * 20000, 'filename': 'a.py', 'path': '.', 'branch': 'main', 'repo': 'bench'}
+    body = json.dumps(payload).encode('utf-8')
+
+    tls_dir = pathlib.Path(tempfile.mkdtemp()) if shutil.which('openssl') else None
+    try:
+        server, host, context = serve(tls_dir)
+
+        def urllib_request():
+            req = urllib.request.Request(host + '/docs/persist', body, {'content-type': 'application/json'})
+            urllib.request.urlopen(req, context=context).read()
+
+        client = ApiClient(host, 'bench', context=context)
+
+        results = {
+            'scheme': host.split(':')[0],
+            'requests': count,
+            'urllib_ms': round(per_request(urllib_request, count), 3),
+            'api_client_ms': round(per_request(lambda: client.post_json('/docs/persist', payload), count), 3),
+        }
+
+        # The server drops the idle connection, the next request has to reconnect transparently
+        time.sleep(KeepAliveHandler.timeout + 0.5)
+        client.post_json('/docs/persist', payload)
+        results['reconnect_after_idle_close'] = 'ok'
+
+        print(json.dumps(results, indent=2))
+        server.shutdown()
+    finally:
+        if tls_dir is not None:
+            shutil.rmtree(str(tls_dir))
+
+
+if __name__ == '__main__':
+    main()
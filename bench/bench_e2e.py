@@ -0,0 +1,281 @@
+"""
+End-to-end benchmark of the plugin against bench/fake_server.py, with docstring.py
+driven headless through bench/fake_vim.py and the real proxy as a subprocess.
+
+For synthetic files of each size it reports:
+  * persist throughput: files and MB per second through persist() and the upload
+    worker, for full uploads and then for one-line edits sent as deltas
+  * generation: time to first token and to the last token, from the request
+    being written to the proxy to the tokens arriving back, for the whole file
+    and then incrementally, after one function in it was edited
+  * tokens applied per second by docgen_cb
+  * memory: peak Python allocations while docgen_cb applies a generation, and
+    the proxy's peak RSS
+
+Results are printed, and written with --output, as JSON for regression tracking.
+
+    python3 bench/bench_e2e.py [--scopes 10,100,1000,5000] [--files 20] [--rtt 0] [--rate 0] [--output FILE]
+
+The vendored websockets 8.1 needs Python 3.9 or older.
+"""
+import argparse
+import json
+import os
+import pathlib
+import platform
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+BENCH = pathlib.Path(__file__).parent
+PLUGIN = BENCH.parent / 'plugin'
+sys.path[:0] = [str(BENCH)]
+
+from fake_server import FakeDocstring
+
+
+def synthetic_file(scopes: int, seed: int = 0) -> list:
+    lines = ['#@docstring']
+    for i in range(scopes):
+        lines += [f'def f{seed}_{i}(x):', '    y = x', '    return y', '']
+    return lines
+
+
+def make_repo(root: pathlib.Path, sizes: list, files: int) -> dict:
+    """
+    Commits `files` synthetic files of every size, returning their paths by size
+    """
+    git = ['git', '-c', 'user.name=bench', '-c', 'user.email=bench@localhost', '-C', str(root)]
+    subprocess.run(git + ['init', '-q'], check=True)
+
+    paths = {}
+    for size in sizes:
+        paths[size] = []
+        for i in range(files):
+            path = root / f'scopes_{size}_{i}.py'
+            path.write_text('\n'.join(synthetic_file(size, i)))
+            paths[size].append(path)
+
+    subprocess.run(git + ['add', '.'], check=True)
+    subprocess.run(git + ['commit', '-q', '-m', 'bench'], check=True)
+    return paths
+
+
+def wait_for_uploads(docstring) -> list:
+    errors = []
+    while docstring.worker.busy():
+        errors += [message for level, message in docstring.worker.poll()]
+        time.sleep(0.002)
+    return errors + [message for level, message in docstring.worker.poll()]
+
+
+def bench_persist(vim, docstring, paths: list) -> dict:
+    buffers = [vim.Buffer(path.read_text().split('\n'), name=str(path)) for path in paths]
+    size = sum(len('\n'.join(buffer)) for buffer in buffers)
+
+    def persist_all():
+        calls = []
+        start = time.perf_counter()
+        for buffer in buffers:
+            vim.current.buffer = buffer
+            called = time.perf_counter()
+            docstring.persist()
+            calls.append(time.perf_counter() - called)
+        errors = wait_for_uploads(docstring)
+        elapsed = time.perf_counter() - start
+        assert not errors, errors
+        return elapsed, sorted(calls)[len(calls) // 2]
+
+    full, full_call = persist_all()
+
+    # One edited line per file, which goes up as a delta
+    for buffer in buffers:
+        buffer[1] = buffer[1].replace('(x)', '(x, edited=True)')
+    delta, delta_call = persist_all()
+
+    return {
+        'persist_files_per_sec': round(len(buffers) / full, 1),
+        'persist_mb_per_sec': round(size / full / 1e6, 2),
+        'persist_call_p50_ms': round(full_call * 1000, 3),
+        'persist_delta_files_per_sec': round(len(buffers) / delta, 1),
+        'persist_delta_call_p50_ms': round(delta_call * 1000, 3),
+    }
+
+
+class Proxy:
+    """
+    The generation proxy, as Vim runs it, with every line it prints timestamped on arrival
+    """
+
+    def __init__(self, fake: FakeDocstring):
+        env = dict(os.environ, API_KEY='bench', DOCSTRING_API_HOST=fake.http_url, DOCSTRING_WS_ENDPOINT=fake.ws_url)
+        started = time.perf_counter()
+        self.process = subprocess.Popen([sys.executable, str(PLUGIN / 'docstring_proxy.py'), '--serve'],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+        self.lines = queue.Queue()
+        threading.Thread(target=self._read, daemon=True).start()
+
+        line, arrived = self.lines.get(timeout=30)
+        assert json.loads(line)['type'] == 'ready', line
+        self.ready = arrived - started
+
+    def _read(self):
+        for line in self.process.stdout:
+            self.lines.put((line.decode('utf-8'), time.perf_counter()))
+
+    def send(self, request: dict) -> float:
+        self.process.stdin.write(json.dumps(request).encode('utf-8') + b'\n')
+        self.process.stdin.flush()
+        return time.perf_counter()
+
+    def peak_rss_kb(self):
+        try:
+            status = pathlib.Path(f'/proc/{self.process.pid}/status').read_text()
+        except OSError:
+            return None
+        for line in status.splitlines():
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+        return None
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait(timeout=10)
+
+
+def bench_generation(vim, docstring, proxy: Proxy, path: pathlib.Path, expected: int,
+                     lines: list = None, full: bool = True) -> dict:
+    lines = lines or path.read_text().split('\n')
+    buffer = vim.current.buffer = vim.Buffer(lines, name=str(path))
+
+    # Registered the way :UpdateDocstring does, docgen_cb ignores generations it doesn't know of
+    request = json.loads(docstring.generation_request(buffer.number, full))
+    request_id = request['id']
+    sent = proxy.send(request)
+
+    messages = []
+    received = 0
+    first = last = None
+    applying = 0.0
+    while True:
+        line, arrived = proxy.lines.get(timeout=120)
+        payload = json.loads(line)
+        if payload.get('id') not in (None, request_id):
+            continue
+        assert payload['type'] != 'error', payload
+        messages.append(line)
+
+        vim.variables['a:msg'] = line
+        started = time.perf_counter()
+        docstring.docgen_cb()
+        if payload['type'] == 'tokens':
+            applying += time.perf_counter() - started
+            received += sum(len(token['text']) // 4 for token in payload['data'])
+            first = first or arrived
+            last = arrived
+        # Only done once the proxy recorded what the next generation diffs against
+        elif payload['type'] == 'done':
+            break
+
+    assert received == expected, (received, expected)
+    assert_applied(buffer, lines, expected)
+
+    # The same messages again on a fresh buffer, for what applying them allocates
+    buffer = vim.current.buffer = vim.Buffer(lines, name=str(path))
+    docstring.generations[request_id] = buffer.number
+    tracemalloc.start()
+    for line in messages:
+        vim.variables['a:msg'] = line
+        docstring.docgen_cb()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert_applied(buffer, lines, expected)
+
+    return {
+        'tokens': received,
+        'time_to_first_token_ms': round((first - sent) * 1000, 2),
+        'time_to_last_token_ms': round((last - sent) * 1000, 2),
+        'tokens_applied_per_sec': round(received / applying) if applying else None,
+        'docgen_peak_kb': round(peak / 1024),
+    }
+
+
+def assert_applied(buffer, lines: list, tokens: int):
+    """
+    Checks templates were inserted and every token landed in the buffer, so the timings measured something
+    """
+    assert len(buffer) > len(lines), f'no templates inserted, the buffer still has {len(buffer)} lines'
+    assert '\n'.join(buffer).count('tok ') == tokens, 'tokens missing from the buffer'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the plugin end to end against a local fake Docstring')
+    parser.add_argument('--scopes', default='10,100,1000,5000', help='Comma separated scope counts of the synthetic files')
+    parser.add_argument('--files', type=int, default=20, help='Files of each size persisted')
+    parser.add_argument('--tokens-per-scope', type=int, default=20)
+    parser.add_argument('--rtt', type=float, default=0.0, help='Seconds of simulated network round trip')
+    parser.add_argument('--rate', type=float, default=0, help='Tokens streamed per second, 0 for unthrottled')
+    parser.add_argument('--output', help='Also write the results to this file')
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.scopes.split(',')]
+
+    tmp = tempfile.TemporaryDirectory()
+    root = pathlib.Path(tmp.name)
+    (root / 'repo').mkdir()
+    paths = make_repo(root / 'repo', sizes, args.files)
+
+    fake = FakeDocstring(args.rtt, args.rate, args.tokens_per_scope).start()
+
+    # docstring.py reads these as it's imported
+    os.environ['XDG_CACHE_HOME'] = str(root / 'cache')
+    os.environ['DOCSTRING_API_HOST'] = fake.http_url
+    sys.modules['vim'] = __import__('fake_vim')
+    sys.path.insert(1, str(PLUGIN))
+    import vim
+    import docstring
+
+    proxy = Proxy(fake)
+    results = []
+    for size in sizes:
+        result = {'scopes': size}
+        result.update(bench_persist(vim, docstring, paths[size]))
+        result.update(bench_generation(vim, docstring, proxy, paths[size][0], size * args.tokens_per_scope))
+
+        # One function edited since the generation above, so only its docs are generated again
+        lines = paths[size][0].read_text().split('\n')
+        edited = 1 + 4 * (size // 2)
+        lines[edited + 1] = lines[edited + 1] + ' + 1'
+        incremental = bench_generation(vim, docstring, proxy, paths[size][0], args.tokens_per_scope,
+                                       lines=lines, full=False)
+        result['incremental_tokens'] = incremental['tokens']
+        result['incremental_time_to_last_token_ms'] = incremental['time_to_last_token_ms']
+        results.append(result)
+        print(json.dumps(result), file=sys.stderr)
+
+    report = {
+        'python': platform.python_version(),
+        'rtt': args.rtt,
+        'rate': args.rate,
+        'tokens_per_scope': args.tokens_per_scope,
+        'files': args.files,
+        'proxy_ready_ms': round(proxy.ready * 1000, 2),
+        'proxy_peak_rss_kb': proxy.peak_rss_kb(),
+        'server_requests': dict(fake.requests),
+        'results': results,
+    }
+
+    proxy.close()
+    fake.stop()
+    tmp.cleanup()
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        pathlib.Path(args.output).write_text(json.dumps(report, indent=2) + '\n')
+
+
+if __name__ == '__main__':
+    main()
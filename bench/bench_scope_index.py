@@ -0,0 +1,91 @@
+"""
+Compares how docgen_cb maps scopes to buffer lines, before and after ScopeIndex,
+on a synthetic file with 1,000 scopes.
+
+    python3 bench/bench_scope_index.py [scopes]
+"""
+import json
+import pathlib
+import sys
+import time
+
+sys.path[:0] = [str(pathlib.Path(__file__).parent), str(pathlib.Path(__file__).parent.parent / 'plugin')]
+sys.modules['vim'] = __import__('fake_vim')
+
+import vim
+import docstring
+from scope_index import ScopeIndex
+
+
+TEMPLATE = '"""\n@startdoc\n@overview \n@details \n@end\n"""'
+
+
+def synthetic_file(scopes: int):
+    lines = ['#@docstring']
+    ranges = []
+    for i in range(scopes):
+        start = len(lines) + 1
+        lines += [f'def f{i}(x):', '    y = x', '    return y', '']
+        ranges.append({'range': {
+            'start': {'line': start},
+            'end': {'line': start + 2},
+            'body_start': {'line': start + 1},
+        }})
+    return lines, ranges
+
+
+def legacy_offsets(anchors, template_length):
+    # The nested loops docgen_cb used before ScopeIndex
+    adjusted = {a: a for a in anchors}
+    after = {a: [] for a in anchors}
+    for i, a in enumerate(anchors):
+        for j in range(len(anchors) - 1, i, -1):
+            after[a].append(anchors[j])
+    for a in anchors:
+        for b in after[a]:
+            adjusted[b] += template_length
+    return adjusted
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    lines, scopes = synthetic_file(count)
+    anchors = [s['range']['body_start']['line'] - 1 for s in scopes]
+
+    legacy, adjusted = timed(lambda: legacy_offsets(anchors, 6))
+    indexed, index = timed(lambda: ScopeIndex(anchors, 6))
+    assert all(adjusted[a] == index.line(i) for i, a in enumerate(anchors))
+
+    buffer = vim.current.buffer = vim.Buffer(lines)
+    # Registered the way :UpdateDocstring does, docgen_cb ignores generations it doesn't know of
+    request_id = json.loads(docstring.generation_request(buffer.number))['id']
+    init = json.dumps({'type': 'init', 'id': request_id,
+                       'data': {'topic': 'bench', 'scopes': scopes, 'template': TEMPLATE, 'position': 'AFTER'}})
+    vim.variables['a:msg'] = init
+    docgen_init, _ = timed(docstring.docgen_cb)
+    assert len(buffer) == len(lines) + count * len(TEMPLATE.split('\n')), 'templates not inserted'
+
+    # Every scope gets a two line overview, which shifts every scope after it
+    tokens = [{'text': 'An overview\nover two lines', 'type': '@overview', 'scope': s} for s in reversed(scopes)]
+    vim.variables['a:msg'] = json.dumps({'type': 'tokens', 'topic': 'bench', 'data': tokens})
+    docgen_tokens, _ = timed(docstring.docgen_cb)
+    assert sum(line.endswith('@overview An overview') for line in buffer) == count, 'tokens not applied'
+    assert sum(line.strip() == 'over two lines' for line in buffer) == count, 'tokens not applied'
+
+    print(json.dumps({
+        'scopes': count,
+        'legacy_offsets_ms': round(legacy * 1000, 2),
+        'scope_index_ms': round(indexed * 1000, 2),
+        'docgen_init_ms': round(docgen_init * 1000, 2),
+        'docgen_multiline_tokens_ms': round(docgen_tokens * 1000, 2),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Measures what the plugin costs at startup: the time Vim spends sourcing the
+plugin (from `vim --startuptime`, when vim has +python3), and the proxy's cold
+start, from launching `docstring_proxy.py` to it having imported everything.
+Each is run several times and the median is reported.
+
+    python3 bench/bench_startup.py [runs]
+"""
+import os
+import pathlib
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = pathlib.Path(__file__).parent.parent
+PLUGIN = ROOT / 'plugin'
+
+
+def proxy_cold_start(python: str) -> float:
+    env = dict(os.environ, API_KEY='bench')
+    start = time.perf_counter()
+    subprocess.run([python, '-c', 'import docstring_proxy'], cwd=str(PLUGIN), env=env, check=True)
+    return time.perf_counter() - start
+
+
+def proxy_imported_modules(python: str) -> int:
+    env = dict(os.environ, API_KEY='bench')
+    out = subprocess.run([python, '-c', 'import sys, docstring_proxy; print(len(sys.modules))'],
+                         cwd=str(PLUGIN), env=env, check=True, stdout=subprocess.PIPE)
+    return int(out.stdout)
+
+
+def vim_has_python3(vim: str) -> bool:
+    out = subprocess.run([vim, '-Nu', 'NONE', '-es', '-c', 'if has("python3") | cq | endif', '-c', 'qa!'],
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return out.returncode != 0
+
+
+def vim_plugin_time(vim: str) -> float:
+    """
+    Returns the milliseconds vim spent sourcing plugin/docstring.vim, and
+    anything it sourced from autoload/ before the first screen was drawn
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        log = pathlib.Path(tmp) / 'startuptime.log'
+        subprocess.run(
+            [vim, '-Nu', 'NONE', '-i', 'NONE', '-es',
+             '--cmd', f'set rtp^={ROOT}', '--cmd', 'let g:docstring_api_key = "bench"',
+             '--cmd', 'runtime plugin/docstring.vim',
+             '--startuptime', str(log), '-c', 'qa!'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True,
+        )
+
+        total = 0.0
+        for line in log.read_text().splitlines():
+            # clock  self+sourced  self:  sourcing <file>
+            parts = line.split(None, 3)
+            if len(parts) == 4 and parts[3].startswith('sourcing ') and str(ROOT) in parts[3]:
+                total += float(parts[1])
+        return total
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    proxy = [proxy_cold_start(sys.executable) for _ in range(runs)]
+    print(f'proxy cold start: {statistics.median(proxy) * 1000:.1f}ms median of {runs}, '
+          f'{proxy_imported_modules(sys.executable)} modules imported')
+
+    vim = shutil.which('vim')
+    if vim is None or not vim_has_python3(vim):
+        print('vim startup: skipped, no vim with +python3')
+        return
+
+    sourcing = [vim_plugin_time(vim) for _ in range(runs)]
+    print(f'vim startup: {statistics.median(sourcing):.2f}ms sourcing the plugin, median of {runs}')
+
+
+if __name__ == '__main__':
+    main()
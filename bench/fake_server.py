@@ -0,0 +1,262 @@
+"""
+A local stand-in for app.docstring.dev, for benchmarking without the real API.
+
+It serves the three endpoints the plugin uses over HTTP/1.1 keep-alive:
+    POST /api/integrations/vscode/docs/persist
+    POST /api/integrations/vscode/readme/persist
+    POST /api/integrations/vscode/docs/create_async
+It also runs a Phoenix channel websocket server, on the vendored websockets.server,
+that streams new_token events for each create_async on the requested topic.
+
+Persists accept gzip bodies and line deltas, answering 409 when the delta's base
+isn't the last version stored. create_async finds a scope for every `def` in the
+file, or only those overlapping the request's line ranges when it has any, and
+streams tokens_per_scope tokens of "tok " for each of them, at `rate`
+tokens per second, or as fast as possible when it's 0. `rtt` seconds are added
+to every request, join and new connection, as a network would.
+
+Point the plugin at it with DOCSTRING_API_HOST and DOCSTRING_WS_ENDPOINT:
+
+    python3 bench/fake_server.py [--rtt SECONDS] [--rate TOKENS_PER_SECOND]
+
+The vendored websockets 8.1 needs Python 3.9 or older.
+"""
+import argparse
+import asyncio
+import gzip
+import http.server
+import json
+import pathlib
+import re
+import socketserver
+import sys
+import threading
+import time
+
+ROOT = pathlib.Path(__file__).parent.parent
+sys.path[:0] = [str(ROOT / 'plugin')]
+sys.path.append(str(ROOT / 'plugin' / 'vendor'))
+
+import websockets
+
+from content_store import apply_delta, content_hash
+
+API_PREFIX = '/api/integrations/vscode'
+TEMPLATE = '"""\n@startdoc\n@overview \n@details \n@end\n"""'
+DEF = re.compile(r'^\s*(async\s+)?def ')
+
+
+def find_scopes(content: str) -> list:
+    """
+    Returns a scope for every function, ending at the next one or the end of the file
+    """
+    lines = content.split('\n')
+    starts = [i for i, line in enumerate(lines) if DEF.match(line)]
+    scopes = []
+    for n, start in enumerate(starts):
+        end = (starts[n + 1] if n + 1 < len(starts) else len(lines)) - 1
+        while end > start and not lines[end].strip():
+            end -= 1
+        scopes.append({'range': {
+            'start': {'line': start + 1},
+            'end': {'line': end + 1},
+            'body_start': {'line': start + 2},
+        }})
+    return scopes
+
+
+class ThreadingServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class FakeDocstring:
+    """
+    Runs both servers on background threads, on ephemeral ports
+    """
+
+    def __init__(self, rtt: float = 0.0, rate: float = 0, tokens_per_scope: int = 20, host: str = '127.0.0.1'):
+        self.rtt = rtt
+        self.rate = rate
+        self.tokens_per_scope = tokens_per_scope
+        self.host = host
+
+        # (repo, branch, path) -> (hash, content) of the last persisted version
+        self.files = {}
+        self.requests = {'persist': 0, 'delta': 0, 'create_async': 0}
+
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._topics = 0
+        self._loop = asyncio.new_event_loop()
+        self._http = None
+        self._ws = None
+
+    @property
+    def http_url(self) -> str:
+        return f'http://{self.host}:{self._http.server_address[1]}'
+
+    @property
+    def ws_url(self) -> str:
+        return f'ws://{self.host}:{self._ws.sockets[0].getsockname()[1]}/socket/websocket'
+
+    def start(self):
+        self._http = ThreadingServer((self.host, 0), self._handler())
+        threading.Thread(target=self._http.serve_forever, name='fake-http', daemon=True).start()
+
+        ready = threading.Event()
+        threading.Thread(target=self._run_ws, args=(ready,), name='fake-ws', daemon=True).start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        self._http.shutdown()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def _run_ws(self, ready: threading.Event):
+        asyncio.set_event_loop(self._loop)
+        self._ws = self._loop.run_until_complete(
+            websockets.serve(self._channel, self.host, 0, process_request=self._handshake, max_size=None))
+        ready.set()
+        self._loop.run_forever()
+
+    # HTTP
+
+    def _handler(self):
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                # A new connection costs a TCP and a TLS handshake
+                time.sleep(2 * fake.rtt)
+                super().setup()
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['content-length']))
+                if self.headers.get('content-encoding') == 'gzip':
+                    body = gzip.decompress(body)
+                time.sleep(fake.rtt)
+
+                status, reply = fake.handle(self.path, json.loads(body.decode('utf-8')))
+                data = json.dumps(reply).encode('utf-8')
+                self.send_response(status)
+                self.send_header('content-type', 'application/json')
+                self.send_header('content-length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def handle(self, path: str, body: dict):
+        """
+        Answers an API request, returning the status and JSON reply
+        """
+        if path in (API_PREFIX + '/docs/persist', API_PREFIX + '/readme/persist'):
+            return self._persist(body)
+        if path == API_PREFIX + '/docs/create_async':
+            return self._create_async(body)
+        return 404, {'error': 'not found'}
+
+    def _persist(self, body: dict):
+        key = (body['repo'], body['branch'], body['path'], body['filename'])
+        with self._lock:
+            self.requests['persist'] += 1
+            if 'delta' in body:
+                last = self.files.get(key)
+                if last is None or last[0] != body['base_hash']:
+                    return 409, {'error': 'unknown base'}
+                self.requests['delta'] += 1
+                content = apply_delta(last[1], body['delta'])
+            else:
+                content = body['content']
+            self.files[key] = (content_hash(content), content)
+        return 200, {}
+
+    def _create_async(self, body: dict):
+        with self._lock:
+            self.requests['create_async'] += 1
+            self._topics += 1
+            topic = body.get('topic') or f'docgen:{self._topics}'
+
+        scopes = find_scopes(body['content'])
+        if 'ranges' in body:
+            scopes = [
+                scope for scope in scopes
+                if any(r['start']['line'] <= scope['range']['end']['line'] and scope['range']['start']['line'] <= r['end']['line']
+                       for r in body['ranges'])
+            ]
+        asyncio.run_coroutine_threadsafe(self._stream(topic, scopes), self._loop)
+        return 200, {'topic': topic, 'scopes': scopes, 'template': TEMPLATE, 'position': 'AFTER'}
+
+    # Websocket
+
+    async def _handshake(self, path, headers):
+        await asyncio.sleep(2 * self.rtt)
+
+    async def _channel(self, ws, path):
+        try:
+            async for raw in ws:
+                msg = json.loads(raw)
+                event = msg['event']
+                if event == 'phx_join':
+                    await asyncio.sleep(self.rtt)
+                    self._subscribers.setdefault(msg['topic'], set()).add(ws)
+                elif event == 'phx_leave':
+                    self._subscribers.get(msg['topic'], set()).discard(ws)
+                await ws.send(json.dumps({'topic': msg['topic'], 'event': 'phx_reply', 'ref': msg.get('ref'),
+                                          'payload': {'status': 'ok', 'response': {}}}))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            for subscribers in self._subscribers.values():
+                subscribers.discard(ws)
+
+    async def _stream(self, topic: str, scopes: list):
+        # Generation starts half a round trip after the response left
+        await asyncio.sleep(self.rtt / 2)
+
+        started = time.perf_counter()
+        sent = 0
+        for scope in scopes:
+            for _ in range(self.tokens_per_scope):
+                frame = json.dumps({'topic': topic, 'event': 'new_token', 'ref': None,
+                                    'payload': {'text': 'tok ', 'type': '@overview', 'scope': scope}})
+                for ws in list(self._subscribers.get(topic, ())):
+                    try:
+                        await ws.send(frame)
+                    except websockets.exceptions.ConnectionClosed:
+                        pass
+                sent += 1
+
+                if self.rate:
+                    ahead = sent / self.rate - (time.perf_counter() - started)
+                    if ahead > 0:
+                        await asyncio.sleep(ahead)
+                elif sent % 256 == 0:
+                    # Let joins and leaves through on long unthrottled streams
+                    await asyncio.sleep(0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a fake Docstring API and websocket locally')
+    parser.add_argument('--rtt', type=float, default=0.0, help='Seconds of simulated network round trip')
+    parser.add_argument('--rate', type=float, default=0, help='Tokens streamed per second, 0 for unthrottled')
+    parser.add_argument('--tokens-per-scope', type=int, default=20)
+    args = parser.parse_args()
+
+    fake = FakeDocstring(args.rtt, args.rate, args.tokens_per_scope).start()
+    print(f'DOCSTRING_API_HOST={fake.http_url}')
+    print(f'DOCSTRING_WS_ENDPOINT={fake.ws_url}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == '__main__':
+    main()
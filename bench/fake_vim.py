@@ -0,0 +1,57 @@
+"""
+Stand-in for Vim's `vim` module, so docstring.py can be driven headless.
+Put this directory first on sys.path, as `vim`, before importing docstring.
+"""
+import re
+
+
+class error(Exception):
+    pass
+
+
+class Buffer(list):
+    """
+    A buffer is a list of lines, with Vim's 0-indexed `append`.
+    """
+
+    def __init__(self, lines=(), name='', number=1):
+        super().__init__(lines)
+        self.name = name
+        self.number = number
+        buffers[number] = self
+
+    def append(self, lines, nr=None):
+        if isinstance(lines, str):
+            lines = [lines]
+        if nr is None:
+            self.extend(lines)
+        else:
+            self[nr:nr] = lines
+
+
+# Buffers by number, the last one created with a number replacing any earlier one
+buffers = {}
+
+
+class current:
+    buffer = Buffer()
+
+
+variables = {
+    'g:docstring_api_key': 'bench',
+}
+
+
+def eval(expr):
+    if expr in variables:
+        return variables[expr]
+    if expr.startswith('has('):
+        return '0'
+    m = re.match(r'(?:expand\()?get\(g:, "(\w+)", (\w+|"[^"]*")\)', expr)
+    if m:
+        return str(variables.get('g:' + m.group(1), m.group(2).strip('"')))
+    raise NotImplementedError(expr)
+
+
+def command(cmd):
+    pass
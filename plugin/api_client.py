@@ -0,0 +1,210 @@
+#@docstring
+from typing import Dict, List, Optional, Tuple
+
+import gzip
+import http.client
+import json
+import os
+import socket
+import ssl
+import threading
+import time
+import urllib.parse
+
+
+API_HOST = 'https://app.docstring.dev'
+if 'DOCSTRING_DEV' in os.environ:
+    API_HOST = 'http://localhost:4000'
+API_HOST = os.environ.get('DOCSTRING_API_HOST', API_HOST)
+
+USER_AGENT = 'docstring-vim/0.1 (https://github.com/Docstring-Dev/docstring-vim)'
+
+# Errors that mean a kept-alive connection was closed by the server while it sat idle
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    ConnectionResetError,
+    ConnectionAbortedError,
+    BrokenPipeError,
+    ssl.SSLEOFError,
+)
+
+
+class ApiError(Exception):
+    """
+    @startdoc
+    Raised when the API answers with an error status
+    @end
+    """
+
+    def __init__(self, status: int, body: str):
+        self.status = status
+        self.body = body
+
+    def __str__(self):
+        return f'HTTP {self.status}: {self.body}'
+
+
+class ApiClient:
+    """
+    @startdoc
+    @overview A thread-safe client for the Docstring API that keeps connections alive between requests.
+    @details Idle connections are pooled and reused, so only the first request pays for DNS and the TCP and
+    TLS handshakes. Connections idle for longer than idle_timeout are closed rather than reused, a reused
+    connection the server has since closed is transparently replaced, and at most max_connections requests
+    are in flight, or connections open, at once.
+    @end
+    """
+
+    def __init__(self, host: str, api_key: str, max_connections: int = 4, idle_timeout: float = 30.0,
+                 context: Optional[ssl.SSLContext] = None):
+        """
+        :param host: Base URL of the API, e.g. https://app.docstring.dev
+        :param api_key: Sent as a bearer token with every request
+        :param max_connections: Cap on concurrent requests, and so on open connections
+        :param idle_timeout: Seconds an idle connection is kept for reuse
+        :param context: SSL context for https hosts, defaults to the system's
+        """
+        url = urllib.parse.urlsplit(host)
+        self.scheme = url.scheme
+        self.netloc = url.netloc
+        self.base_path = url.path.rstrip('/')
+        self.api_key = api_key
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.context = context
+
+        self._lock = threading.Lock()
+        self._idle: List[Tuple[http.client.HTTPConnection, float]] = []
+        self._slots = threading.BoundedSemaphore(max_connections)
+
+    def _connect(self, timeout: Optional[float]) -> http.client.HTTPConnection:
+        if self.scheme == 'https':
+            conn = http.client.HTTPSConnection(self.netloc, timeout=timeout, context=self.context)
+        else:
+            conn = http.client.HTTPConnection(self.netloc, timeout=timeout)
+
+        # http.client writes the headers and body separately, which on a kept-alive
+        # connection stalls on Nagle's algorithm until the server's delayed ACK
+        conn.connect()
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return conn
+
+    def _checkout(self) -> Optional[http.client.HTTPConnection]:
+        now = time.monotonic()
+        with self._lock:
+            while self._idle:
+                conn, last_used = self._idle.pop()
+                if now - last_used < self.idle_timeout:
+                    return conn
+                conn.close()
+        return None
+
+    def _checkin(self, conn: http.client.HTTPConnection):
+        with self._lock:
+            self._idle.append((conn, time.monotonic()))
+            # Connections are checked out newest first, so the oldest is the one least likely to be reused
+            stale = self._idle[:-self.max_connections]
+            del self._idle[:-self.max_connections]
+        for old, _ in stale:
+            old.close()
+
+    def warm(self, timeout: Optional[float] = None):
+        """
+        @startdoc
+        Opens a connection ahead of the next request, if none is idle, so it doesn't wait on the handshakes.
+        Takes a request slot while connecting, and does nothing if they're all taken as one will soon be free.
+        @end
+        """
+        if not self._slots.acquire(blocking=False):
+            return
+        try:
+            with self._lock:
+                if self._idle:
+                    return
+            self._checkin(self._connect(timeout))
+        finally:
+            self._slots.release()
+
+    def headers(self) -> Dict[str, str]:
+        """
+        @startdoc
+        Returns the headers sent with every request
+        @end
+        """
+        return {
+            'User-Agent': USER_AGENT,
+            'authorization': f'Bearer {self.api_key}',
+            'content-type': 'application/json',
+        }
+
+    def request(self, method: str, path: str, body: Optional[bytes] = None,
+                headers: Optional[Dict[str, str]] = None, timeout: Optional[float] = None) -> bytes:
+        """
+        @startdoc
+        @overview Sends a request over a pooled connection and returns the response body.
+        @details Raises ApiError for error statuses, and OSError or http.client.HTTPException when the API can't be reached.
+        @end
+        """
+        all_headers = self.headers()
+        all_headers.update(headers or {})
+
+        with self._slots:
+            conn = self._checkout()
+            reused = conn is not None
+            if conn is None:
+                conn = self._connect(timeout)
+
+            while True:
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+
+                try:
+                    conn.request(method, self.base_path + path, body, all_headers)
+                    resp = conn.getresponse()
+                    data = resp.read()
+                    break
+                except STALE_CONNECTION_ERRORS:
+                    conn.close()
+                    if not reused:
+                        raise
+                    # Only a connection that sat idle gets a second chance, with a fresh connection
+                    reused = False
+                    conn = self._connect(timeout)
+                except BaseException:
+                    conn.close()
+                    raise
+
+            if resp.will_close:
+                conn.close()
+            else:
+                self._checkin(conn)
+
+        if resp.status >= 400:
+            raise ApiError(resp.status, data.decode('utf-8', 'replace'))
+        return data
+
+    def post_json(self, path: str, payload: dict, compress: bool = False, timeout: Optional[float] = None) -> bytes:
+        """
+        @startdoc
+        POSTs a JSON body to the API, gzipped if asked to
+        @end
+        """
+        body = json.dumps(payload).encode('utf-8')
+        headers = {}
+        if compress:
+            body = gzip.compress(body)
+            headers['content-encoding'] = 'gzip'
+        return self.request('POST', path, body, headers, timeout)
+
+    def close(self):
+        """
+        @startdoc
+        Closes every idle connection
+        @end
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
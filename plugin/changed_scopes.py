@@ -0,0 +1,123 @@
+#@docstring
+from typing import List, Tuple
+
+import re
+
+from content_store import line_opcodes
+
+
+DOCS_START = re.compile(r'^\W*@startdoc\b')
+DOCS_END = re.compile(r'^\W*@end\b')
+
+# The comment delimiters around a docs block, like """ or /** and */, belong to it
+DELIMITER = re.compile(r'^\s*("""|\'\'\'|/\*\*?|\*/|\*|#|//)\s*$')
+
+
+def docs_blocks(lines: List[str]) -> List[Tuple[int, int]]:
+    """
+    @startdoc
+    Returns the 0-indexed, inclusive line ranges of the docs blocks in a file's lines, with their comment delimiters
+    @end
+    """
+    blocks = []
+
+    i = 0
+    while i < len(lines):
+        if not DOCS_START.match(lines[i]):
+            i += 1
+            continue
+
+        start = i
+        while i < len(lines) and not DOCS_END.match(lines[i]):
+            i += 1
+        end = min(i, len(lines) - 1)
+
+        while start > 0 and DELIMITER.match(lines[start - 1]):
+            start -= 1
+        while end + 1 < len(lines) and DELIMITER.match(lines[end + 1]):
+            end += 1
+
+        blocks.append((start, end))
+        i = end + 1
+    return blocks
+
+
+def code_lines(content: str) -> Tuple[List[str], List[int]]:
+    """
+    @startdoc
+    @overview Returns the lines of a file outside of its docs blocks, along with their 1-indexed line numbers.
+    @details Docs are left out so that generating or editing them never counts as a change to the code they document.
+    @end
+    """
+    lines = content.split('\n')
+    skip = [False] * len(lines)
+    for start, end in docs_blocks(lines):
+        for j in range(start, end + 1):
+            skip[j] = True
+
+    kept = [n for n in range(len(lines)) if not skip[n]]
+    return [lines[n] for n in kept], [n + 1 for n in kept]
+
+
+def changed_ranges(base: str, content: str) -> List[Tuple[int, int]]:
+    """
+    @startdoc
+    @overview Returns the 1-indexed, inclusive line ranges of content whose code differs from base.
+    @details Lines removed from base mark the lines on either side of where they were.
+    @end
+    """
+    a, _ = code_lines(base)
+    b, numbers = code_lines(content)
+    if not numbers:
+        return []
+
+    ranges = []
+    for tag, i1, i2, j1, j2 in line_opcodes(a, b):
+        if tag == 'equal':
+            continue
+        if j2 > j1:
+            ranges.append((numbers[j1], numbers[j2 - 1]))
+        else:
+            ranges.append((numbers[max(j1 - 1, 0)], numbers[min(j1, len(numbers) - 1)]))
+    return ranges
+
+
+def touched_scopes(scopes: List[dict], ranges: List[Tuple[int, int]]) -> List[dict]:
+    """
+    @startdoc
+    Returns the scopes, as create_async returns them, whose lines overlap any of the changed ranges
+    @end
+    """
+    return [
+        scope for scope in scopes
+        if any(start <= scope['range']['end']['line'] and scope['range']['start']['line'] <= end for start, end in ranges)
+    ]
+
+
+def undocumented_scopes(scopes: List[dict], content: str, before: bool) -> List[dict]:
+    """
+    @startdoc
+    @overview Returns the scopes, as create_async returns them, that have no docs block where docs would be inserted.
+    @details That is right above the scope when docs go before it, or at the top of its body otherwise.
+    Blank lines in between are allowed.
+    @end
+    """
+    lines = content.split('\n')
+    in_docs = [False] * len(lines)
+    for start, end in docs_blocks(lines):
+        for j in range(start, end + 1):
+            in_docs[j] = True
+
+    undocumented = []
+    for scope in scopes:
+        if before:
+            i = scope['range']['start']['line'] - 2
+            while i >= 0 and not lines[i].strip():
+                i -= 1
+        else:
+            i = scope['range']['body_start']['line'] - 1
+            while i < len(lines) and not lines[i].strip():
+                i += 1
+        if not 0 <= i < len(lines) or not in_docs[i]:
+            undocumented.append(scope)
+    return undocumented
@@ -1,15 +1,235 @@
 #@docstring
-from typing import List, Optional
+from typing import Dict, List, Optional, Set, Tuple
 
 import logging
 import os
 import pathlib
+import struct
 import subprocess
 
 
 NULL = open('/dev/null', 'w')
 
 
+class RepoMetadata:
+    """
+    @startdoc
+    @overview Caches the branch and tracked files of a git repository, read straight from its git directory.
+    @details Answers are invalidated whenever .git/HEAD or .git/index change, so steady-state lookups never fork git.
+    @end
+    """
+
+    def __init__(self, root: pathlib.Path, git_dir: pathlib.Path):
+        self.root = root
+        self.git_dir = git_dir
+        self._head_stat = None
+        self._branch = None
+        self._index_stat = None
+        self._tracked: Optional[Set[bytes]] = None
+
+    def branch(self) -> str:
+        """
+        @startdoc
+        Returns the current branch, or HEAD when detached, like `git rev-parse --abbrev-ref HEAD`
+        @end
+        """
+        head = self.git_dir / 'HEAD'
+        st = _stat_key(head)
+        if st is None or st != self._head_stat:
+            self._branch = _read_head(head)
+            self._head_stat = st
+        return self._branch
+
+    def is_tracked(self, fn: str) -> bool:
+        """
+        @startdoc
+        Checks if a path, relative to the repository root, is in the index
+        @end
+        """
+        index = self.git_dir / 'index'
+        st = _stat_key(index)
+        if self._tracked is None or st != self._index_stat:
+            self._tracked = _read_index_paths(index, str(self.root))
+            self._index_stat = st
+        return os.fsencode(pathlib.PurePath(fn).as_posix()) in self._tracked
+
+
+# Repository metadata keyed by repo root, and repo roots keyed by directory
+_repos: Dict[str, RepoMetadata] = {}
+_repo_roots: Dict[str, Tuple[pathlib.Path, pathlib.Path]] = {}
+
+
+def _stat_key(path: pathlib.Path) -> Optional[Tuple[int, int]]:
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _find_git_dir(directory: str) -> Optional[Tuple[pathlib.Path, pathlib.Path]]:
+    """
+    @startdoc
+    Walks up from a directory to the closest worktree root, returning it along with its git directory
+    @end
+    """
+    cached = _repo_roots.get(directory)
+    if cached is not None and (cached[0] / '.git').exists():
+        return cached
+
+    current = pathlib.Path(directory)
+    for candidate in [current] + list(current.parents):
+        dot_git = candidate / '.git'
+        if dot_git.is_dir():
+            found = (candidate, dot_git)
+        elif dot_git.is_file():
+            # Worktrees and submodules point at their git directory with a "gitdir: <path>" file
+            with open(dot_git) as f:
+                line = f.readline().strip()
+            if not line.startswith('gitdir: '):
+                return None
+            found = (candidate, (candidate / line[len('gitdir: '):]).resolve())
+        else:
+            continue
+
+        _repo_roots[directory] = found
+        return found
+
+    return None
+
+
+def _read_head(head: pathlib.Path) -> str:
+    with open(head) as f:
+        ref = f.read().strip()
+    if ref.startswith('ref: '):
+        ref = ref[len('ref: '):]
+        if ref.startswith('refs/heads/'):
+            ref = ref[len('refs/heads/'):]
+        return ref
+    return 'HEAD'
+
+
+def _read_varint(data: bytes, offset: int) -> Tuple[int, int]:
+    # The offset encoding used by index v4 path compression, see git's varint.c
+    c = data[offset]
+    offset += 1
+    value = c & 127
+    while c & 128:
+        c = data[offset]
+        offset += 1
+        value = ((value + 1) << 7) | (c & 127)
+    return value, offset
+
+
+def parse_index(data: bytes) -> Set[bytes]:
+    """
+    @startdoc
+    @overview Parses the paths out of a git index file (versions 2 to 4).
+    @details Raises ValueError for anything it doesn't understand, such as sparse directory entries,
+    or a split index, whose entries are mostly in a shared index file.
+    @end
+    """
+    if data[:4] != b'DIRC':
+        raise ValueError('not a git index')
+    version, count = struct.unpack_from('>II', data, 4)
+    if version not in (2, 3, 4):
+        raise ValueError(f'unsupported index version {version}')
+
+    paths = set()
+    offset = 12
+    previous = b''
+    for _ in range(count):
+        entry_start = offset
+        mode, = struct.unpack_from('>I', data, offset + 24)
+        flags, = struct.unpack_from('>H', data, offset + 60)
+        offset += 62
+        if version >= 3 and flags & 0x4000:
+            offset += 2
+
+        if mode & 0o170000 == 0o040000:
+            raise ValueError('sparse index')
+
+        if version == 4:
+            strip, offset = _read_varint(data, offset)
+            end = data.index(b'\0', offset)
+            name = previous[:len(previous) - strip] + data[offset:end]
+            offset = end + 1
+        else:
+            end = data.index(b'\0', offset)
+            name = data[offset:end]
+            # Entries are NUL-padded to a multiple of 8 bytes
+            offset = entry_start + ((end - entry_start) // 8 + 1) * 8
+
+        paths.add(name)
+        previous = name
+
+    # Extensions follow the entries, up to the trailing checksum (20 bytes with SHA-1)
+    while offset + 8 <= len(data) - 20:
+        signature = data[offset:offset + 4]
+        if not signature.isalpha():
+            break
+        if signature == b'link':
+            raise ValueError('split index')
+        if signature == b'sdir':
+            raise ValueError('sparse index')
+        size, = struct.unpack_from('>I', data, offset + 4)
+        offset += 8 + size
+
+    return paths
+
+
+def _read_index_paths(index: pathlib.Path, repo: str) -> Set[bytes]:
+    try:
+        with open(index, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        # Nothing has ever been staged
+        return set()
+
+    try:
+        paths = parse_index(data)
+    except (ValueError, struct.error, IndexError) as e:
+        logging.debug(f'Falling back to ls-files for {repo}: {e}')
+        out = subprocess.check_output([
+            'git',
+            '-C', repo,
+            'ls-files', '-z',
+        ], stderr=NULL)
+        paths = set(out.split(b'\0')[:-1])
+
+    logging.debug(f'Read {len(paths)} tracked files for {repo}')
+    return paths
+
+
+def get_repo_metadata(repo: str) -> Optional[RepoMetadata]:
+    """
+    @startdoc
+    @overview Returns the cached metadata for the repository containing a directory.
+    @details Returns None when the directory isn't inside a git worktree.
+    @end
+    """
+    found = _find_git_dir(os.path.realpath(repo))
+    if found is None:
+        return None
+
+    root, git_dir = found
+    metadata = _repos.get(str(root))
+    if metadata is None or metadata.git_dir != git_dir:
+        metadata = RepoMetadata(root, git_dir)
+        _repos[str(root)] = metadata
+    return metadata
+
+
+def get_cache_dir() -> pathlib.Path:
+    """
+    @startdoc
+    Returns the directory local state is kept in, following the XDG base directory spec
+    @end
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return pathlib.Path(base) / 'docstring-vim'
+
+
 # Copypasta from git post-merge.py
 # TODO: have a proper python library for this, or a common file that's symlinked
 def get_repo_root(fn: str) -> Optional[pathlib.Path]:
@@ -18,6 +238,10 @@ def get_repo_root(fn: str) -> Optional[pathlib.Path]:
     @overview This code defines a function that takes a git repository as input and returns the root of the git repository.
     @end
     """
+    if 'GIT_DIR' not in os.environ:
+        metadata = get_repo_metadata(os.path.dirname(fn))
+        return metadata.root if metadata is not None else None
+
     try:
         root = subprocess.check_output([
             'git',
@@ -56,6 +280,10 @@ def get_current_branch(repo: str) -> str:
     @details This code defines a function that gets the current branch of a git repository.
     @end
     """
+    metadata = get_repo_metadata(repo) if 'GIT_DIR' not in os.environ else None
+    if metadata is not None:
+        return metadata.branch()
+
     branch = subprocess.check_output([
         'git',
         '-C', repo,
@@ -85,20 +313,95 @@ def get_files_in_commit(repo: str, commit: str) -> List[str]:
     """
     @startdoc
     @overview This function gets the files in the last commit.
-    @details This code gets the files in the last commit.
+    @details This code gets the files in the last commit. Root commits list every file, and merges are compared to their first parent.
+    That's git log's job: diff-tree lists a merge's changes from every parent even with --first-parent,
+    and --diff-merges=first-parent needs git 2.31.
     @end
     """
     files = subprocess.check_output([
         'git',
         '-C', repo,
-        'diff',
-        '--name-only',
-        commit + '~', commit,
-    ], stderr=NULL).decode('utf-8').split('\n')[:-1]
+        'log',
+        '-1', '-m', '--first-parent',
+        '--format=', '--name-only', '-z',
+        commit,
+    ], stderr=NULL).decode('utf-8').split('\0')[:-1]
     logging.debug(f'Got files in last commit: {files}')
     return files
 
 
+def get_files_changed_since(repo: str, commit: str) -> List[str]:
+    """
+    @startdoc
+    @overview Gets the files that changed between a commit and HEAD, such as ORIG_HEAD after a merge.
+    @end
+    """
+    files = subprocess.check_output([
+        'git',
+        '-C', repo,
+        'diff',
+        '--name-only', '-z',
+        commit, 'HEAD',
+    ], stderr=NULL).decode('utf-8').split('\0')[:-1]
+    logging.debug(f'Got files changed since {commit}: {files}')
+    return files
+
+
+def get_file_at_head(repo: str, fn: str) -> Optional[str]:
+    """
+    @startdoc
+    @overview Returns the contents of a file, relative to the repository root, as of the last commit.
+    @details Returns None if there is no commit yet, the file isn't in it, or it isn't text.
+    @end
+    """
+    try:
+        content = subprocess.check_output([
+            'git',
+            '-C', repo,
+            'show', f'HEAD:{pathlib.PurePath(fn).as_posix()}',
+        ], stderr=NULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    try:
+        return content.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+
+
+def get_docstring_files(repo: str) -> List[str]:
+    """
+    @startdoc
+    @overview Lists every tracked file that Docstring persists: READMEs and files tagged @docstring.
+    @details The tag is searched for by git grep, which is far faster than reading every file from Python.
+    @end
+    """
+    try:
+        tagged = subprocess.check_output([
+            'git',
+            '-C', repo,
+            'grep', '-l', '-z', '-I', '-F',
+            '-e', '@docstring',
+        ], stderr=NULL).decode('utf-8').split('\0')[:-1]
+    except subprocess.CalledProcessError:
+        # git grep exits with 1 when nothing matches
+        tagged = []
+
+    readmes = [
+        fn for fn in subprocess.check_output([
+            'git',
+            '-C', repo,
+            'ls-files', '-z',
+            ':(icase)*readme.md',
+        ], stderr=NULL).decode('utf-8').split('\0')[:-1]
+        if pathlib.PurePath(fn).name.lower() == 'readme.md'
+    ]
+
+    files = sorted(set(tagged) | set(readmes))
+    logging.debug(f'Got {len(files)} docstring files')
+    return files
+
+
 def is_file_tracked(repo: str, fn: str) -> bool:
     """
     @startdoc
@@ -106,6 +409,10 @@ def is_file_tracked(repo: str, fn: str) -> bool:
     @details This code is a function that checks if a file is tracked by git.
     @end
     """
+    metadata = get_repo_metadata(repo) if 'GIT_DIR' not in os.environ else None
+    if metadata is not None:
+        return metadata.is_tracked(fn)
+
     out = subprocess.check_output([
         'git',
         '-C', repo,
@@ -0,0 +1,187 @@
+#@docstring
+from typing import Dict, List, Optional, Tuple
+
+import difflib
+import gzip
+import hashlib
+import os
+import pathlib
+import tempfile
+import threading
+
+
+def content_hash(content: str) -> str:
+    """
+    @startdoc
+    Hashes file contents the same way for the local store and the API
+    @end
+    """
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def line_opcodes(a: List[str], b: List[str]) -> List[Tuple[str, int, int, int, int]]:
+    """
+    @startdoc
+    @overview Returns the SequenceMatcher opcodes that turn the lines a into the lines b.
+    @details The common prefix and suffix are trimmed before diffing, so small edits to large files stay linear.
+    @end
+    """
+    prefix = 0
+    limit = min(len(a), len(b))
+    while prefix < limit and a[prefix] == b[prefix]:
+        prefix += 1
+
+    suffix = 0
+    limit -= prefix
+    while suffix < limit and a[len(a) - 1 - suffix] == b[len(b) - 1 - suffix]:
+        suffix += 1
+
+    opcodes = []
+    if prefix:
+        opcodes.append(('equal', 0, prefix, 0, prefix))
+
+    matcher = difflib.SequenceMatcher(None, a[prefix:len(a) - suffix], b[prefix:len(b) - suffix], autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        opcodes.append((tag, prefix + i1, prefix + i2, prefix + j1, prefix + j2))
+
+    if suffix:
+        opcodes.append(('equal', len(a) - suffix, len(a), len(b) - suffix, len(b)))
+    return opcodes
+
+
+def line_delta(base: str, content: str) -> list:
+    """
+    @startdoc
+    @overview Builds a line diff that turns base into content.
+    @details The delta is a list of ops applied in order to the base lines:
+    ["=", n] keeps n lines, ["-", n] drops n lines and ["+", lines] inserts lines.
+    @end
+    """
+    b = content.split('\n')
+
+    ops: List[list] = []
+    for tag, i1, i2, j1, j2 in line_opcodes(base.split('\n'), b):
+        if tag == 'equal':
+            ops.append(['=', i2 - i1])
+            continue
+        if i2 > i1:
+            ops.append(['-', i2 - i1])
+        if j2 > j1:
+            ops.append(['+', b[j1:j2]])
+    return ops
+
+
+def apply_delta(base: str, delta: list) -> str:
+    """
+    @startdoc
+    Applies a delta from line_delta to base, the inverse of what the server does with it
+    @end
+    """
+    a = base.split('\n')
+    out = []
+    i = 0
+    for op, arg in delta:
+        if op == '=':
+            out.extend(a[i:i + arg])
+            i += arg
+        elif op == '-':
+            i += arg
+        else:
+            out.extend(arg)
+    return '\n'.join(out)
+
+
+class ContentStore:
+    """
+    @startdoc
+    @overview Remembers the last contents Docstring acknowledged for each (repo, branch, path).
+    @details Each record is a gzip file named after its key, so it survives restarts and can be used as a delta base.
+    The hashes are kept in memory once read, so checking whether a save changed anything only stats the file.
+    Other Vim sessions and sync.py share the records, so a hash is read again once its file was replaced.
+    @end
+    """
+
+    def __init__(self, directory: pathlib.Path):
+        self.directory = directory
+        self._lock = threading.Lock()
+        # key -> (stamp of the record file the hash is from, hash), None for a missing file or hash
+        self._hashes: Dict[Tuple[str, str, str], Tuple[Optional[tuple], Optional[str]]] = {}
+
+    def _path(self, key: Tuple[str, str, str]) -> pathlib.Path:
+        name = hashlib.sha1('\0'.join(key).encode('utf-8')).hexdigest()
+        return self.directory / (name + '.gz')
+
+    @staticmethod
+    def _stamp(st: os.stat_result) -> tuple:
+        # Records are replaced rather than rewritten, so a new version always changes at least the inode
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _stat(self, key: Tuple[str, str, str]) -> Optional[tuple]:
+        try:
+            return self._stamp(os.stat(str(self._path(key))))
+        except OSError:
+            return None
+
+    def _read(self, key: Tuple[str, str, str]) -> Tuple[Optional[tuple], Optional[str]]:
+        """
+        Returns the stamp and contents of a record, read from the same file
+        """
+        try:
+            with open(str(self._path(key)), 'rb') as f:
+                stamp = self._stamp(os.fstat(f.fileno()))
+                try:
+                    with gzip.GzipFile(fileobj=f, mode='rb') as gz:
+                        return stamp, gz.read().decode('utf-8')
+                except (OSError, EOFError, UnicodeDecodeError):
+                    return stamp, None
+        except OSError:
+            return None, None
+
+    def last_hash(self, key: Tuple[str, str, str]) -> Optional[str]:
+        """
+        @startdoc
+        Returns the hash of the last acknowledged contents for a key, if there are any
+        @end
+        """
+        with self._lock:
+            cached = self._hashes.get(key)
+            if cached is None or cached[0] != self._stat(key):
+                stamp, content = self._read(key)
+                cached = self._hashes[key] = stamp, content_hash(content) if content is not None else None
+            return cached[1]
+
+    def get(self, key: Tuple[str, str, str]) -> Optional[Tuple[str, str]]:
+        """
+        @startdoc
+        Returns the (hash, contents) last acknowledged for a key, if there are any
+        @end
+        """
+        with self._lock:
+            stamp, content = self._read(key)
+            if content is None:
+                self._hashes[key] = stamp, None
+                return None
+            digest = content_hash(content)
+            self._hashes[key] = stamp, digest
+            return digest, content
+
+    def put(self, key: Tuple[str, str, str], content: str):
+        """
+        @startdoc
+        Records contents as acknowledged for a key. The record is replaced atomically,
+        so a crash leaves either the old or the new version.
+        @end
+        """
+        with self._lock:
+            digest = content_hash(content)
+            try:
+                self.directory.mkdir(parents=True, exist_ok=True)
+                fd, tmp = tempfile.mkstemp(dir=str(self.directory), suffix='.tmp')
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(gzip.compress(content.encode('utf-8')))
+                    stamp = self._stamp(os.fstat(f.fileno()))
+                os.replace(tmp, str(self._path(key)))
+            except OSError:
+                # The in-memory hash still dedups for this session, until another process replaces the record
+                stamp = self._stat(key)
+            self._hashes[key] = stamp, digest
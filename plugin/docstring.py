@@ -1,15 +1,21 @@
 #@docstring
+from typing import List
+
 import json
 import logging
-import os
 import pathlib
 import re
 import sys
-import urllib.error
-import urllib.request
 import vim
 
-from common import get_repo_root, get_current_branch, is_file_tracked
+from api_client import API_HOST, ApiClient
+from common import get_cache_dir, get_repo_root, get_current_branch, is_file_tracked
+from content_store import ContentStore, content_hash
+from persist_worker import PersistWorker
+from persister import Persister, make_job
+from scope_index import ScopeIndex
+from spool import Spool
+from stats import stats
 
 
 if (sys.version_info < (3, 6)):
@@ -17,13 +23,11 @@ if (sys.version_info < (3, 6)):
     sys.exit(1)
 
 
-API_HOST = 'https://app.docstring.dev'
-if 'DOCSTRING_DEV' in os.environ:
-    API_HOST = 'http://localhost:4000'
-
-API_ENDPOINT = API_HOST + '/api/integrations/vscode'
 API_KEY = vim.eval('g:docstring_api_key')
 
+# Shared by the persist worker's uploads, so they reuse a kept-alive connection
+client = ApiClient(API_HOST, API_KEY)
+
 DOC_BEFORE = "BEFORE"
 
 
@@ -36,150 +40,184 @@ def verbose():
     return bool(int(vim.eval('get(g:, "docstring_verbose", 0)')))
 
 
-def persist():
+stats.configure(
+    bool(int(vim.eval('get(g:, "docstring_stats", 0)'))),
+    vim.eval('expand(get(g:, "docstring_trace_file", ""))'),
+)
+
+store = ContentStore(get_cache_dir() / 'persisted')
+persister = Persister(client, store)
+
+
+def upload(key: tuple, job: dict) -> bool:
     """
     @startdoc
-    Persists the contents of the current buffer to Docstring
+    Uploads a persisted file on the worker thread, timing it
     @end
     """
-    contents = '\n'.join(vim.current.buffer)
+    started = stats.start()
+    try:
+        return persister.upload(key, job)
+    finally:
+        stats.stop('persist.upload', started)
+
+
+# Saves that couldn't reach Docstring, uploaded once it can be reached again, even in a later session
+spool = Spool(get_cache_dir() / 'spool.jsonl')
+worker = PersistWorker(upload, spool=spool)
+if spool.exists():
+    worker.start()
+
 
+# What persist() tells Vim, which caches the buffer as ineligible until the index changes on NOT_TRACKED
+NOT_TRACKED = -1
+NOT_QUEUED = 0
+QUEUED = 1
+
+
+def persist() -> int:
+    """
+    @startdoc
+    @overview Queues the contents of the current buffer to be persisted to Docstring.
+    @details Vim has already ruled out buffers it can tell aren't eligible, including ones without the @docstring marker.
+    Returns QUEUED, NOT_QUEUED, or NOT_TRACKED when the file isn't tracked by git.
+    @end
+    """
     cur_file = vim.current.buffer.name
 
     if not pathlib.Path(cur_file).exists():
-        return
+        return NOT_QUEUED
 
+    started = stats.start()
     repo_root = get_repo_root(cur_file)
 
     if repo_root is None:
         if verbose():
             print(f'Docstring: Not persisting file {cur_file}: not in a git repository')
-        return
+        return NOT_TRACKED
 
     relative_file = pathlib.Path(cur_file).relative_to(repo_root)
     branch = get_current_branch(str(repo_root))
     #repo_origin = get_origin_url(str(repo_root))
     repo = repo_root.name
 
-    if relative_file.name.lower() != 'readme.md' and '@docstring' not in contents:
-        if verbose():
-            print(f'Docstring: Not persisting file {relative_file}: "@docstring" not in file')
-        return
-
     if not is_file_tracked(str(repo_root), str(relative_file)):
         if verbose():
             print(f'Docstring: Not persisting file {relative_file}: not tracked by git')
-        return
+        return NOT_TRACKED
+    stats.stop('persist.git', started)
 
-    post_data = json.dumps({
-        'content': '\n'.join(vim.current.buffer),  # TODO: figure out line ending from mode?
-        'filename': relative_file.name,
-        'path': str(relative_file.parent),
-        'branch': branch,
-        'repo': repo,
-    }).encode('utf-8')
-
-    if relative_file.name.lower() == 'readme.md':
-        endpoint = API_ENDPOINT + '/readme/persist'
-    else:
-        endpoint = API_ENDPOINT + '/docs/persist'
-
-    req = urllib.request.Request(endpoint)
-    req.add_header('User-Agent', 'docstring-vim/0.1 (https://github.com/Whize-Co/docstring-vim)')
-    req.add_header('authorization', f'Bearer {API_KEY}')
-    req.add_header('content-type', 'application/json')
-    req.add_header('content-length', str(len(post_data)))
-
-    # Timeout so that we don't hold up editor operations if hitting the API is slow
-    try:
-        urllib.request.urlopen(req, post_data, timeout=5)
-    except urllib.error.HTTPError as e:
-        body = e.read().decode("utf-8")
-        print(f'Docstring: Error saving: {body}')
-        return
-    except urllib.error.URLError as e:
-        return
+    queued = stats.start()
+    contents = '\n'.join(vim.current.buffer)  # TODO: figure out line ending from mode?
+    key, job = make_job(repo, branch, relative_file, contents)
+
+    # Nothing changed since the last acknowledged upload. A queued or running upload of
+    # another version still has to be superseded though, or it would win.
+    if store.last_hash(key) == content_hash(contents) and not worker.has_work_for(key):
+        if verbose():
+            print(f'Docstring: Not persisting file {relative_file}: unchanged since last save')
+        return NOT_QUEUED
+
+    if not worker.submit(key, job):
+        print(f'Docstring: Not persisting file {relative_file}: too many saves waiting to upload')
+        return NOT_QUEUED
+    stats.stop('persist.queue', queued)
+    return QUEUED
+
+
+def poll_persist() -> bool:
+    """
+    @startdoc
+    Reports the outcome of background uploads. Called from a Vim timer while uploads are pending.
+    Returns whether there is still work in flight.
+    @end
+    """
+    for level, message in worker.poll():
+        if verbose() or level >= logging.ERROR:
+            print(message)
+    return worker.busy()
+
+
+def spool_pending():
+    """
+    @startdoc
+    Spools the uploads still queued or running as Vim exits, so they are done next time
+    @end
+    """
+    worker.spool_pending()
 
 
 async_state = {}
 
+# Request id -> number of the buffer docs are being generated for, until the proxy is done with it
+generations = {}
+next_request_id = 1
 
-def docgen_cb():
+# Files requested since the last time no generation was running, for reporting progress
+batch_size = 0
+
+HAS_TEXTPROP = vim.eval("has('textprop')") == '1'
+
+# Text property ids are unique for the session, one per scope being generated
+next_prop_id = 1
+
+
+def template_sections(template: List[str]) -> List[int]:
     """
     @startdoc
-    Callback handler for async document generation.
-    Called each time a line from docstring_proxy.py is received by vim.
+    Returns the offsets, from the top of the template, of the lines overview and details tokens are appended to
     @end
     """
-    payload = json.loads(vim.eval("a:msg"))
-    if payload['type'] == 'init':
-        scopes = payload['data']['scopes']
-        template = payload['data']['template']
-        position = payload['data']['position']
+    overview = next((i for i, line in enumerate(template) if '@overview' in line), 2)
+    details = next((i for i, line in enumerate(template) if '@details' in line), overview + 1)
+    return [overview, details]
 
-        scopesByDocStart = {}
-        templateLength = len(template.split("\n"))
 
-        for i, scope in enumerate(scopes):
-            # -1 because vim line numbers are 0-indexed, but we get 1-indexed from API
-            scopeEnd = scope['range']['end']['line'] - 1
+def locate(state: dict, i: int) -> bool:
+    """
+    @startdoc
+    @overview Checks the docs of a scope are still where the index thinks they are.
+    @details The top line of each inserted template carries a text property, which Vim keeps on that line
+    whatever the user edits. If it has moved, the index is corrected for it and every scope after it.
+    Returns False if the line is gone.
+    @end
+    """
+    if not HAS_TEXTPROP:
+        return True
 
-            previousTemplateadjustment = templateLength * i;
-
-            whitespace = ''
-
-            # docsStart is the line number _before_ which the doc should be added
-            # meaning the docs will then be on that line
-            if position == DOC_BEFORE:
-                scopeStart = scope['range']['start']['line'] - 1
-                docsStart = scopeStart
-                whitespace = re.match(r'\s*', vim.current.buffer[scopeStart+previousTemplateadjustment]).group()
-            else:
-                scopeBodyStart = scope['range']['body_start']['line'] - 1
-                docsStart = scopeBodyStart
-
-                # indent to the indentation of the first, non-empty line in the body of the scope
-                for line in vim.current.buffer[scopeBodyStart+previousTemplateadjustment:scopeEnd+previousTemplateadjustment+1]:
-                    if line.strip() != '':
-                        whitespace = re.match(r'\s*', line).group()
-                        break
-
-            scopesByDocStart[docsStart] = {
-                'scope': scope,
-                'scopesAfter': [],
-                'adjustedOverviewStart': docsStart + 2,
-                'adjustedDetailsStart': docsStart + 3,
-                'adjustedDocEnd': docsStart + 4,
-            }
-
-            tabAdjustedTemplate = map(lambda line: whitespace + line, template.split("\n"))
-
-            vim.current.buffer.append(list(tabAdjustedTemplate), docsStart + previousTemplateadjustment)
-
-            for j in range(len(scopes) - 1, i, -1):
-                scopeAfter = scopes[j]
-                if position == DOC_BEFORE:
-                    scopeAfterDocsStart = scopeAfter['range']['start']['line'] - 1
-                else:
-                    scopeAfterDocsStart = scopeAfter['range']['body_start']['line'] - 1
-                scopesByDocStart[docsStart]["scopesAfter"].append(scopeAfterDocsStart)
-
-        for thing in scopesByDocStart.values():
-            for scopeLine in thing['scopesAfter']:
-                scopesByDocStart[scopeLine]['adjustedOverviewStart'] += templateLength
-                scopesByDocStart[scopeLine]['adjustedDetailsStart'] += templateLength
-                scopesByDocStart[scopeLine]['adjustedDocEnd'] += templateLength
-
-        async_state[payload['data']['topic']] = {
-            'position': position,
-            'scopesByDocStart': scopesByDocStart,
-        }
+    index = state['index']
+    expected = index.line(i)
+    # Lines deleted since, or an undone template, can leave the expected line past the end of the buffer
+    lnum = max(1, min(expected + 1, len(state['buffer'])))
+    props = f'{{"type": "docstring_doc", "id": {state["props"] + i}, "bufnr": {state["buffer"].number}, "lnum": {lnum}, "col": 1}}'
 
-    elif payload['type'] == 'token':
-        data = payload['data']
+    try:
+        found = vim.eval(f'prop_find({props}, "f")') or vim.eval(f'prop_find({props}, "b")')
+    except vim.error:
+        return False
+    if not found:
+        return False
+
+    index.shift_from(i, int(found['lnum']) - 1 - expected)
+    return True
 
-        position = async_state[payload['topic']]['position']
-        scopesByDocStart = async_state[payload['topic']]['scopesByDocStart']
+
+def apply_tokens(state: dict, tokens: list):
+    """
+    @startdoc
+    @overview Appends a batch of tokens to the docs they belong to, writing each affected line once.
+    @details Tokens containing newlines add lines to the docs, which shifts every scope after them in the index.
+    @end
+    """
+    position = state['position']
+    index = state['index']
+    buffer = state['buffer']
+
+    # Concatenate the batch per scope and section, keeping arrival order
+    appends = {}
+    for data in tokens:
+        if data['text'] == '\n':
+            continue
 
         payloadScope = data['scope']
 
@@ -188,19 +226,256 @@ def docgen_cb():
         else:
             docsStart = payloadScope['range']['body_start']['line'] - 1
 
+        try:
+            i = index.find(docsStart)
+        except KeyError:
+            continue
+
+        section = 0 if data['type'] == "@overview" else 1
+        appends[(i, section)] = appends.get((i, section), '') + data['text']
+
+    located = set()
+    for (i, section), text in appends.items():
+        if i in state['lost']:
+            continue
+        if i not in located:
+            if not locate(state, i):
+                state['lost'].add(i)
+                continue
+            located.add(i)
+
+        sections = state['sections'][i]
+        insertPosition = index.line(i) + sections[section]
+
+        lines = text.split('\n')
+        buffer[insertPosition] = buffer[insertPosition] + lines[0]
+
+        if len(lines) > 1:
+            added = len(lines) - 1
+            buffer.append([state['whitespace'][i] + line for line in lines[1:]], insertPosition + 1)
+
+            # Keep appending to the last line of this section, and move every section below it
+            current = sections[section]
+            for s, offset in enumerate(sections):
+                if offset >= current:
+                    sections[s] += added
+            index.shift_from(i + 1, added)
+
+
+def generation_request(bufnr: int, full: bool = False) -> str:
+    """
+    @startdoc
+    @overview Returns the line asking the proxy to generate docs for a buffer, remembering which buffer the request is for.
+    @details The proxy only generates docs for the scopes whose code changed since last time, or for every scope when full is set.
+    @end
+    """
+    global next_request_id, batch_size
+
+    buffer = vim.buffers[bufnr]
+    request_id = next_request_id
+    next_request_id += 1
+
+    generations[request_id] = bufnr
+    batch_size += 1
+
+    return json.dumps({
+        'id': request_id,
+        'file': buffer.name,
+        'content': '\n'.join(buffer) + '\n',
+        'full': full,
+    }) + '\n'
+
+
+def init_generation(data: dict, buffer) -> dict:
+    """
+    @startdoc
+    @overview Inserts an empty docs template for every scope in the init message and indexes where they went.
+    @details Templates are inserted bottom-up, so the lines above each insertion, which are read for indentation,
+    are still at their original positions.
+    @end
+    """
+    global next_prop_id
+
+    position = data['position']
+    template = data['template'].split("\n")
+    templateLength = len(template)
+
+    # docsStart is the line number _before_ which the doc should be added
+    # meaning the docs will then be on that line
+    # -1 because vim line numbers are 0-indexed, but we get 1-indexed from API
+    scopesByDocStart = {}
+    for scope in data['scopes']:
+        if position == DOC_BEFORE:
+            docsStart = scope['range']['start']['line'] - 1
+        else:
+            docsStart = scope['range']['body_start']['line'] - 1
+        scopesByDocStart.setdefault(docsStart, scope)
+
+    anchors = sorted(scopesByDocStart)
+    whitespaces = [''] * len(anchors)
+
+    for i in range(len(anchors) - 1, -1, -1):
+        docsStart = anchors[i]
         scope = scopesByDocStart[docsStart]
-        docsEndLine = scope["adjustedDocEnd"]
 
-        if data['type'] == "@overview":
-            insertPosition = scope["adjustedDetailsStart"] - 1
+        whitespace = ''
+        if position == DOC_BEFORE:
+            whitespace = re.match(r'\s*', buffer[docsStart]).group()
         else:
-            insertPosition = docsEndLine - 1
+            scopeEnd = scope['range']['end']['line'] - 1
 
-        if data['text'] == '\n':
+            # indent to the indentation of the first, non-empty line in the body of the scope
+            for line in buffer[docsStart:scopeEnd+1]:
+                if line.strip() != '':
+                    whitespace = re.match(r'\s*', line).group()
+                    break
+
+        whitespaces[i] = whitespace
+        buffer.append([whitespace + line for line in template], docsStart)
+
+    index = ScopeIndex(anchors, templateLength)
+    sections = template_sections(template)
+
+    state = {
+        'position': position,
+        'buffer': buffer,
+        'index': index,
+        'sections': [list(sections) for _ in anchors],
+        'whitespace': whitespaces,
+        'props': next_prop_id,
+        'lost': set(),
+    }
+    next_prop_id += len(anchors)
+
+    if HAS_TEXTPROP and anchors:
+        lines = [[index.line(i) + 1, state['props'] + i] for i in range(len(anchors))]
+        vim.command(
+            f'for [lnum, id] in {json.dumps(lines)} | '
+            f'call prop_add(lnum, 1, {{"type": "docstring_doc", "id": id, "bufnr": {buffer.number}, "length": 0}}) | '
+            'endfor'
+        )
+
+    return state
+
+
+def docgen_cb():
+    """
+    @startdoc
+    Callback handler for async document generation.
+    Called each time a line from docstring_proxy.py is received by vim.
+    @end
+    """
+    payload = json.loads(vim.eval("a:msg"))
+    if payload['type'] == 'init':
+        # Tokens go to the buffer the request was made from, whichever buffer is current now.
+        # A request that is no longer known, like one abandoned with a dead proxy, has nowhere to go.
+        bufnr = generations.get(payload.get('id'))
+        if bufnr is None:
             return
+        try:
+            buffer = vim.buffers[bufnr]
+        except KeyError:
+            return
+
+        started = stats.start()
+        async_state[payload['data']['topic']] = init_generation(payload['data'], buffer)
+        stats.stop('vim.init_generation', started, id=payload.get('id'))
 
-        vim.current.buffer[insertPosition] += data['text']
+    elif payload['type'] == 'tokens':
+        state = async_state.get(payload['topic'])
+        if state is not None:
+            started = stats.start()
+            apply_tokens(state, payload['data'])
+            stats.stop('vim.apply_tokens', started)
+
+    elif payload['type'] == 'token':
+        state = async_state.get(payload['topic'])
+        if state is not None:
+            apply_tokens(state, [payload['data']])
+
+    elif payload['type'] == 'done':
+        finish_generation(payload.get('id'), payload.get('topic'))
+
+    elif payload['type'] == 'stats':
+        stats.record(payload['name'], payload['value'], payload['unit'], id=payload['id'])
 
     elif payload['type'] == 'error':
-        if verbose() or payload['level'] >= logging.ERROR:
+        if verbose() or payload['level'] >= logging.WARNING:
             print(payload['message'])
+
+
+def remove_anchors(state: dict):
+    """
+    @startdoc
+    Removes the text properties marking the docs of a finished generation. Only its own, as another
+    generation may still be streaming into the same buffer.
+    @end
+    """
+    if not HAS_TEXTPROP or not len(state['index']):
+        return
+
+    ids = list(range(state['props'], state['props'] + len(state['index'])))
+    try:
+        vim.command(
+            f'for id in {json.dumps(ids)} | '
+            f'call prop_remove({{"type": "docstring_doc", "id": id, "bufnr": {state["buffer"].number}, "both": 1, "all": 1}}) | '
+            'endfor'
+        )
+    except vim.error:
+        # The buffer was wiped, along with its properties
+        pass
+
+
+def finish_generation(request_id, topic):
+    """
+    @startdoc
+    Forgets a generation the proxy is done with, reporting when the last of several finishes
+    @end
+    """
+    global batch_size
+
+    state = async_state.pop(topic, None)
+    if state is not None:
+        remove_anchors(state)
+    bufnr = generations.pop(request_id, None)
+    if bufnr is None:
+        return
+
+    if verbose():
+        print(f'Docstring: Finished generating docs for buffer {bufnr}')
+    if not generations:
+        if batch_size > 1:
+            print(f'Docstring: Finished generating docs for {batch_size} files')
+        batch_size = 0
+
+
+def abandon_generations():
+    """
+    @startdoc
+    Forgets every generation in progress, when the proxy running them exits
+    @end
+    """
+    global batch_size
+
+    for state in async_state.values():
+        remove_anchors(state)
+    async_state.clear()
+    generations.clear()
+    batch_size = 0
+
+
+def print_stats():
+    """
+    @startdoc
+    Prints the percentiles of every timing collected this session
+    @end
+    """
+    if not stats.enabled:
+        print('Docstring: Stats are off, set g:docstring_stats = 1 to collect them')
+        return
+
+    lines = stats.summary()
+    if not lines:
+        print('Docstring: Nothing measured yet')
+    for line in lines:
+        print(line)
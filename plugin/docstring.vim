@@ -14,36 +14,38 @@ if !exists('g:docstring_api_key')
     finish
 endif
 
-let s:plugin_root_dir = fnamemodify(resolve(expand('<sfile>:p')), ':h')
-
-python3 << EOF
-import sys
-import vim
-plugin_root_dir = vim.eval('s:plugin_root_dir')
-sys.path.insert(0, plugin_root_dir)
-import docstring
-EOF
-
-function s:docgen_cb(channel, msg)
-    python3 docstring.docgen_cb()
-endfunction
+" Everything else lives in autoload/docstring.vim and is only loaded when used
 
 function! UpdateDocstring()
-    let job = job_start(["timeout", "30s", "/usr/bin/python3", s:plugin_root_dir . "/docstring_proxy.py", expand('%:p')], {
-                \ 'in_io': 'buffer',
-                \ 'in_buf': bufnr('%'),
-                \ 'out_cb': function('s:docgen_cb'),
-                \ 'env': {'API_KEY': g:docstring_api_key}
-                \ })
+    call docstring#update()
 endfunction
 
-command! -nargs=0 UpdateDocstring call UpdateDocstring()
-
+function! UpdateDocstringAll(...)
+    call call('docstring#update_all', a:000)
+endfunction
 
 function! SaveDocstring()
-    python3 docstring.persist()
+    call docstring#save()
 endfunction
 
-command! -nargs=0 SaveDocstring call SaveDocstring()
+function! DocstringStats()
+    call docstring#stats()
+endfunction
 
-autocmd BufWritePost * SaveDocstring
+function! DocstringSyncRepo(...)
+    call call('docstring#sync_repo', a:000)
+endfunction
+
+command! -nargs=0 -bang UpdateDocstring call docstring#update(bufnr('%'), <bang>0)
+command! -nargs=? -bang -complete=customlist,docstring#update_all_complete UpdateDocstringAll call docstring#update_all(<q-args>, <bang>0)
+command! -nargs=0 SaveDocstring call docstring#save()
+command! -nargs=0 DocstringStats call docstring#stats()
+command! -nargs=? -complete=dir DocstringSyncRepo call docstring#sync_repo(<q-args>)
+
+autocmd BufWritePost * call docstring#save()
+
+" Saves left over from a session that couldn't reach Docstring are uploaded once Vim is up
+let s:spool = (empty($XDG_CACHE_HOME) ? expand('~/.cache') : $XDG_CACHE_HOME) . '/docstring-vim/spool.jsonl'
+if filereadable(s:spool)
+    autocmd VimEnter * call timer_start(0, {-> docstring#resume_uploads()})
+endif
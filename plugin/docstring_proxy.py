@@ -1,39 +1,243 @@
+from typing import Optional, Tuple
+
+import asyncio
+import http.client
 import json
 import logging
 import os
 import pathlib
 import sys
-import urllib.error
-import urllib.request
+import threading
+import time
+import uuid
 
 sys.path.append(str(pathlib.Path(__file__).parent / 'vendor'))
 
 from realtime_py.connection import Socket
 
-from common import get_repo_root, get_current_branch, is_file_tracked
+from api_client import API_HOST, ApiClient, ApiError
+from changed_scopes import changed_ranges, touched_scopes, undocumented_scopes
+from common import get_cache_dir, get_file_at_head, get_repo_root, get_current_branch, is_file_tracked
+from content_store import ContentStore
+from stats import stats
 
 
-API_ENDPOINT = 'https://app.docstring.dev/api/integrations/vscode/docs/create_async'
 WS_ENDPOINT = 'wss://app.docstring.dev/socket/websocket'
 if 'DOCSTRING_DEV' in os.environ:
-    API_ENDPOINT = 'http://localhost:4000/api/integrations/vscode/docs/create_async'
     WS_ENDPOINT = 'ws://localhost:4000/socket/websocket'
+WS_ENDPOINT = os.environ.get('DOCSTRING_WS_ENDPOINT', WS_ENDPOINT)
 
+API_ENDPOINT = '/api/integrations/vscode/docs/create_async'
 API_KEY = os.environ['API_KEY']
 
-if __name__ == "__main__":
-    cur_file = sys.argv[1]
-    contents = sys.stdin.read()
+# Kept for the life of the proxy, so generations after the first skip the TLS handshake
+client = ApiClient(API_HOST, API_KEY)
+
+# The contents docs were last generated from, per (repo, branch, path), which later generations diff against
+generated = ContentStore(get_cache_dir() / 'generated')
+
+# The API doesn't say when a generation is done. It is taken to be over once every scope got tokens and
+# none came for SETTLE_TIMEOUT seconds. Until then the server may be pausing between scopes, so only a gap of
+# IDLE_TIMEOUT seconds ends it, or no token at all for FIRST_TOKEN_TIMEOUT, which is what the one-shot
+# proxy's `timeout 30s` used to allow. GENERATION_TIMEOUT caps how long a topic is kept joined whatever it streams.
+FIRST_TOKEN_TIMEOUT = 30
+IDLE_TIMEOUT = float(os.environ.get('DOCSTRING_IDLE_TIMEOUT', 30))
+SETTLE_TIMEOUT = 3
+GENERATION_TIMEOUT = 300
+
+# Generations run at once, the others wait for a slot
+MAX_GENERATIONS = int(os.environ.get('DOCSTRING_MAX_GENERATIONS', 8))
+
+# Tokens are sent to Vim in batches, flushed after this many seconds or once this many bytes are buffered
+FLUSH_INTERVAL = 0.03
+FLUSH_BYTES = 4096
+
+# Requests carry the whole buffer, so allow lines far longer than asyncio's 64k default
+MAX_REQUEST_SIZE = 2 ** 28
+
+
+# Repo checks run on executor threads and report from there
+_emit_lock = threading.Lock()
+
+
+def emit(message: dict):
+    """
+    @startdoc
+    Writes a single message to Vim, one JSON object per line
+    @end
+    """
+    line = json.dumps(message) + '\n'
+    with _emit_lock:
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+
+def emit_stat(name: str, value: float, unit: str, fields: dict):
+    """
+    @startdoc
+    Sends a timing to Vim, which aggregates them
+    @end
+    """
+    emit({
+        'type': 'stats',
+        'id': fields.get('id'),
+        'name': name,
+        'value': value,
+        'unit': unit,
+    })
+
+
+stats.sink = emit_stat
+stats.configure('DOCSTRING_STATS' in os.environ)
+
+
+def socket_timing(phase: str, seconds: float):
+    """
+    @startdoc
+    Records how long the socket took to connect or join a topic
+    @end
+    """
+    stats.record(f'ws.{phase}', seconds * 1000)
+
+
+def emit_error(level: int, message: str, request_id=None):
+    """
+    @startdoc
+    Reports an error (or an informational message, depending on level) to Vim
+    @end
+    """
+    emit({
+        'type': 'error',
+        'id': request_id,
+        'level': level,
+        'message': message,
+    })
+
+
+class TokenBatcher:
+    """
+    @startdoc
+    @overview Buffers the tokens streamed for a topic and sends them to Vim as one "tokens" message.
+    @details Consecutive tokens for the same scope and section are concatenated, so Vim only has to
+    rewrite each affected line once per batch instead of once per token.
+    @end
+    """
 
+    def __init__(self, topic: str, interval: float = FLUSH_INTERVAL, max_bytes: int = FLUSH_BYTES,
+                 request_id=None, started: float = 0.0):
+        """
+        :param request_id: Id of the request the tokens answer, for stats
+        :param started: When the request was received, from stats.start()
+        """
+        self.topic = topic
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self._pending = {}
+        self._size = 0
+        self._timer = None
+
+        # Tokens can arrive before Vim has been sent the init message they belong to
+        self.held = True
+        self._sent = False
+
+        self.request_id = request_id
+        self.started = started
+        self.tokens = 0
+        self._first_at = self.last_token_at = 0.0
+        # Start lines of the scopes tokens came for
+        self.scopes = set()
+
+    def add(self, payload: dict):
+        """
+        @startdoc
+        Buffers a new_token payload, flushing if the batch is full
+        @end
+        """
+        # Bare newlines separate sections and are dropped by Vim anyway
+        if payload['text'] == '\n':
+            return
+
+        self.last_token_at = time.perf_counter()
+        if not self.tokens:
+            self._first_at = self.last_token_at
+        self.tokens += 1
+
+        scope_range = payload['scope']['range']
+        key = (scope_range['start']['line'], scope_range['end']['line'], payload['type'])
+        self.scopes.add(key[0])
+
+        pending = self._pending.get(key)
+        if pending is None:
+            self._pending[key] = dict(payload)
+        else:
+            pending['text'] += payload['text']
+        self._size += len(payload['text'])
+
+        if self.held:
+            return
+        # The first tokens go out straight away, it's only worth waiting to batch the ones after them
+        if self._size >= self.max_bytes or not self._sent:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(self.interval, self.flush)
+
+    def release(self):
+        """
+        @startdoc
+        Starts sending tokens to Vim, beginning with the ones that arrived while held
+        @end
+        """
+        self.held = False
+        self.flush()
+
+    def flush(self):
+        """
+        @startdoc
+        Sends everything buffered so far
+        @end
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        if self.held or not self._pending:
+            return
+
+        emit({
+            'type': 'tokens',
+            'topic': self.topic,
+            'data': list(self._pending.values()),
+        })
+        self._pending = {}
+        self._size = 0
+
+        if not self._sent:
+            stats.stop('generate.first_token', self.started, id=self.request_id)
+        self._sent = True
+
+    def record_rate(self):
+        """
+        @startdoc
+        Records the rate tokens streamed in at, from the first to the last
+        @end
+        """
+        if self.tokens > 1 and self.last_token_at > self._first_at:
+            stats.record('generate.tokens_per_sec', (self.tokens - 1) / (self.last_token_at - self._first_at),
+                         unit='tok/s', id=self.request_id)
+
+
+def check_file(cur_file: str, contents: str, request_id=None):
+    """
+    @startdoc
+    Checks that a file can have docs generated for it.
+    Returns the relative path, branch and repo name, or None after reporting why not.
+    @end
+    """
     repo_root = get_repo_root(cur_file)
 
     if repo_root is None:
-        print(json.dumps({
-            'type': 'error',
-            'level': logging.INFO,
-            'message': f'Docstring: Not persisting file {cur_file}: not in a git repository',
-        }))
-        sys.exit(0)
+        emit_error(logging.INFO, f'Docstring: Not persisting file {cur_file}: not in a git repository', request_id)
+        return None
 
     relative_file = pathlib.Path(cur_file).relative_to(repo_root)
     branch = get_current_branch(str(repo_root))
@@ -41,64 +245,316 @@ if __name__ == "__main__":
     repo = repo_root.name
 
     if relative_file.name.lower() != 'readme.md' and '@docstring' not in contents:
-        print(json.dumps({
-            'type': 'error',
-            'level': logging.INFO,
-            'message': f'Docstring: Not persisting file {relative_file}: "@docstring" not in file',
-        }))
-        sys.exit(0)
+        emit_error(logging.INFO, f'Docstring: Not persisting file {relative_file}: "@docstring" not in file', request_id)
+        return None
 
     if not is_file_tracked(str(repo_root), str(relative_file)):
-        print(json.dumps({
-            'type': 'error',
-            'level': logging.INFO,
-            'message': f'Docstring: Not persisting file {relative_file}: not tracked by git',
-        }))
-        sys.exit(0)
+        emit_error(logging.INFO, f'Docstring: Not persisting file {relative_file}: not tracked by git', request_id)
+        return None
+
+    return relative_file, branch, repo
+
+
+def find_changes(cur_file: str, relative_file: pathlib.Path, branch: str, repo: str,
+                 contents: str) -> Tuple[Optional[list], bool]:
+    """
+    @startdoc
+    @overview Returns the line ranges whose code changed since docs were last generated for a file, and whether
+    docs were ever generated for it.
+    @details The contents of the last generation are compared against, or the file as of the last commit if
+    there was none. The ranges are None when there is neither, and everything has to be generated.
+    @end
+    """
+    last = generated.get((repo, branch, str(relative_file)))
+    if last is not None:
+        return changed_ranges(last[1], contents), True
+
+    base = get_file_at_head(str(get_repo_root(cur_file)), str(relative_file))
+    if base is None:
+        return None, False
+    return changed_ranges(base, contents), False
 
-    s = Socket(f"{WS_ENDPOINT}?token={API_KEY}")
-    s.connect()
 
-    post_data = json.dumps({
+def create_async(relative_file: pathlib.Path, branch: str, repo: str, contents: str, topic: str,
+                 ranges: Optional[list] = None) -> dict:
+    """
+    @startdoc
+    Asks the API to start generating docs for a file, streaming the tokens on a topic the proxy already joined.
+    With ranges, only the scopes overlapping those lines are asked for.
+    Returns the scopes, template and the topic the tokens will actually be streamed on.
+    @end
+    """
+    body = {
         'content': contents,
         'filename': relative_file.name,
         'path': str(relative_file.parent),
         'branch': branch,
         'repo': repo,
-    }).encode('utf-8')
+        'topic': topic,
+    }
+    if ranges is not None:
+        body['ranges'] = [{'start': {'line': start}, 'end': {'line': end}} for start, end in ranges]
+    resp = client.post_json(API_ENDPOINT, body)
+    return json.loads(resp.decode('utf-8'))
 
-    req = urllib.request.Request(API_ENDPOINT)
-    req.add_header('User-Agent', 'docstring-vim/0.1 (https://github.com/Docstring-Dev/docstring-vim)')
-    req.add_header('authorization', f'Bearer {API_KEY}')
-    req.add_header('content-type', 'application/json')
-    req.add_header('content-length', str(len(post_data)))
 
+async def streamed(batcher: TokenBatcher, scopes: list) -> bool:
+    """
+    @startdoc
+    Waits until the tokens for a generation stop coming.
+    Returns whether every one of the scopes got tokens, rather than the stream timing out.
+    @end
+    """
+    expected = {scope['range']['start']['line'] for scope in scopes}
+    released = time.perf_counter()
+    while True:
+        now = time.perf_counter()
+        complete = expected <= batcher.scopes
+        if not batcher.tokens:
+            done_at = released + FIRST_TOKEN_TIMEOUT
+        elif complete:
+            done_at = batcher.last_token_at + SETTLE_TIMEOUT
+        else:
+            done_at = batcher.last_token_at + IDLE_TIMEOUT
+        done_at = min(done_at, released + GENERATION_TIMEOUT)
+        if now >= done_at:
+            return complete
+        # Woken up at least every SETTLE_TIMEOUT, to notice tokens arriving
+        await asyncio.sleep(min(done_at - now, SETTLE_TIMEOUT))
+
+
+async def subscribe(s: Socket, connected: asyncio.Future, topic: str, batcher: TokenBatcher):
+    """
+    @startdoc
+    Joins a topic once the socket is connected, buffering its tokens in a batcher.
+    Returns the channel, and whether the server acknowledged the join.
+    @end
+    """
+    await asyncio.shield(connected)
+
+    chan = s.set_channel(topic)
+    chan.on("new_token", batcher.add)
     try:
-        resp = urllib.request.urlopen(req, post_data)
-    except urllib.error.HTTPError as e:
-        body = e.read().decode("utf-8")
-        print(json.dumps({
-            'type': 'error',
-            'level': logging.ERROR,
-            'message': f'Docstring: Error generating: {body}',
-        }))
-        sys.exit(0)
+        return chan, await chan._join()
+    except asyncio.CancelledError:
+        await chan._leave()
+        raise
+
+
+async def generate(s: Socket, connected: asyncio.Future, cur_file: str, contents: str, request_id=None, full: bool = False):
+    """
+    @startdoc
+    @overview Runs a single generation over the socket, streaming the init message and every token for it back to Vim.
+    @details The repo checks run while the socket connects and joins a topic the proxy picked, so the join is
+    acknowledged before the generation is requested and no token can be missed. Servers that ignore the
+    requested topic are followed to theirs, joining it only once generation has started as before.
+    Unless full is set, only the scopes whose code changed since the last generation get docs.
+    @end
+    """
+    loop = asyncio.get_event_loop()
+
+    started = stats.start()
+
+    topic = f'docgen:{uuid.uuid4().hex}'
+    batcher = TokenBatcher(topic, request_id=request_id, started=started)
+
+    subscribing = asyncio.ensure_future(subscribe(s, connected, topic, batcher))
+    checking = loop.run_in_executor(None, check_file, cur_file, contents, request_id)
+    warming = loop.run_in_executor(None, client.warm)
+
+    chan = None
+    try:
+        checked = await checking
+        stats.stop('generate.repo_checks', started, id=request_id)
+        if checked is None:
+            return
+        relative_file, branch, repo = checked
+
+        ranges = None
+        generated_before = False
+        if not full:
+            diffed = stats.start()
+            ranges, generated_before = await loop.run_in_executor(
+                None, find_changes, cur_file, relative_file, branch, repo, contents)
+            stats.stop('generate.find_changes', diffed, id=request_id)
+            if ranges == [] and generated_before:
+                emit_error(logging.WARNING, f'Docstring: No code changed in {relative_file} since docs were last generated', request_id)
+                return
+
+        chan, joined = await subscribing
+
+        try:
+            await warming
+            posted = stats.start()
+            # Scopes that never got docs are only known from the reply, so a file docs were never generated
+            # for asks for all of them
+            j = await loop.run_in_executor(None, create_async, relative_file, branch, repo, contents, topic,
+                                           ranges if generated_before else None)
+            stats.stop('generate.create_async', posted, id=request_id)
+        except ApiError as e:
+            emit_error(logging.ERROR, f'Docstring: Error generating: {e.body}', request_id)
+            return
+        except (OSError, http.client.HTTPException) as e:
+            emit_error(logging.ERROR, f'Docstring: Error generating: {e}', request_id)
+            return
+
+        if j['topic'] != topic or not joined:
+            await chan._leave()
+            batcher = TokenBatcher(j['topic'], request_id=request_id, started=started)
+            chan, joined = await subscribe(s, connected, j['topic'], batcher)
+
+        # While reconnecting the join fails, but the socket rejoins the channel once it's back
+        if not joined and s.connected:
+            emit_error(logging.ERROR, f'Docstring: Could not subscribe to the docs generated for {relative_file}', request_id)
+            return
+
+        # Servers that ignore the ranges send every scope, the unchanged ones keep the docs they have.
+        # Without an earlier generation, scopes without docs get them whether or not they changed.
+        if ranges is not None:
+            scopes = j['scopes']
+            j['scopes'] = touched_scopes(scopes, ranges)
+            if not generated_before:
+                undocumented = undocumented_scopes(scopes, contents, j.get('position') == 'BEFORE')
+                j['scopes'] = [scope for scope in scopes if scope in j['scopes'] or scope in undocumented]
+            if not j['scopes']:
+                emit_error(logging.WARNING, f'Docstring: No code changed in {relative_file} since the last commit, '
+                                            'and every function has docs', request_id)
+
+        emit({
+            'type': 'init',
+            'id': request_id,
+            'data': j,
+        })
+        batcher.release()
+
+        if not j['scopes']:
+            return
+        complete = await streamed(batcher, j['scopes'])
+
+        # Only a generation that got docs for every scope becomes the baseline for the next one,
+        # otherwise the scopes it missed would count as unchanged from then on
+        if complete and batcher.tokens:
+            await loop.run_in_executor(None, generated.put, (repo, branch, str(relative_file)), contents)
+
+    finally:
+        # Failing to warm up a connection only matters once the POST is made, and is reported then
+        warming.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+        if chan is None and subscribing.done() and not subscribing.cancelled() and not subscribing.exception():
+            chan = subscribing.result()[0]
+        elif chan is None:
+            subscribing.cancel()
+        batcher.flush()
+        batcher.record_rate()
+        if chan is not None:
+            await chan._leave()
 
-    j = json.loads(resp.read().decode('utf-8'))
+        # Sent for every request, however it ended, so Vim knows the buffer is free
+        emit({
+            'type': 'done',
+            'id': request_id,
+            'topic': batcher.topic,
+        })
 
-    print(json.dumps({
-        'type': 'init',
-        'data': j,
-    }))
 
-    def cb(payload):
-        print(json.dumps({
-            'type': 'token',
-            'topic': j['topic'],
-            'data': payload,
-        }))
+async def handle_request(s: Socket, connected: asyncio.Future, limit: asyncio.Semaphore, line: bytes):
+    """
+    @startdoc
+    Decodes one request line from Vim and runs the generation it asks for once a slot is free
+    @end
+    """
+    try:
+        request = json.loads(line.decode('utf-8'))
+    except ValueError:
+        emit_error(logging.ERROR, 'Docstring: Malformed request to proxy')
+        return
+
+    try:
+        async with limit:
+            await generate(s, connected, request['file'], request['content'], request.get('id'), request.get('full', False))
+    except Exception:
+        logging.exception('Generation failed')
+        emit_error(logging.ERROR, f'Docstring: Error generating docs for {request["file"]}', request.get('id'))
+
+
+async def read_requests(s: Socket, connected: asyncio.Future):
+    """
+    @startdoc
+    Reads JSON-lines requests from stdin until Vim closes it,
+    starting a generation for each of them
+    @end
+    """
+    loop = asyncio.get_event_loop()
+    reader = asyncio.StreamReader(limit=MAX_REQUEST_SIZE)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    limit = asyncio.Semaphore(MAX_GENERATIONS)
+
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+        if line.strip():
+            asyncio.ensure_future(handle_request(s, connected, limit, line))
+
+
+async def serve():
+    """
+    @startdoc
+    Keeps a single socket to Docstring open for the whole Vim session and
+    multiplexes every generation over it. The socket reconnects and rejoins
+    the topics being generated on its own if the connection drops. Exits when
+    stdin closes.
+    @end
+    """
+    s = Socket(f"{WS_ENDPOINT}?token={API_KEY}", timing=socket_timing if stats.enabled else None)
+
+    # Requests are read, and their repos checked, while the socket connects
+    connected = asyncio.ensure_future(s._connect())
+    reading = asyncio.ensure_future(read_requests(s, connected))
+    try:
+        await connected
+    except BaseException:
+        reading.cancel()
+        raise
+
+    emit({'type': 'ready'})
+
+    tasks = [
+        reading,
+        asyncio.ensure_future(s._listen()),
+        asyncio.ensure_future(s._keep_alive()),
+    ]
+    await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+
+    for task in tasks:
+        task.cancel()
+    await s._close()
+
+
+if __name__ == "__main__":
+    loop = asyncio.get_event_loop()
+
+    if sys.argv[1:] == ['--serve']:
+        loop.run_until_complete(serve())
+        sys.exit(0)
+
+    # One-shot mode: generate docs for a single file read from stdin
+    cur_file = sys.argv[1]
+    contents = sys.stdin.read()
+
+    s = Socket(f"{WS_ENDPOINT}?token={API_KEY}", timing=socket_timing if stats.enabled else None)
+    connected = asyncio.ensure_future(s._connect())
 
-    chan = s.set_channel(j['topic'])
-    chan.join().on("new_token", cb)
+    async def one_shot():
+        generating = asyncio.ensure_future(generate(s, connected, cur_file, contents))
+        await asyncio.wait([generating, connected], return_when=asyncio.FIRST_COMPLETED)
+        if connected.done() and not connected.exception():
+            await asyncio.wait([
+                generating,
+                asyncio.ensure_future(s._listen()),
+                asyncio.ensure_future(s._keep_alive()),
+            ], return_when=asyncio.FIRST_COMPLETED)
+        else:
+            await generating
 
-    s.listen()
+    loop.run_until_complete(one_shot())
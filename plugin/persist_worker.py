@@ -0,0 +1,248 @@
+#@docstring
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+import logging
+import queue
+import threading
+import http.client
+import time
+
+from api_client import ApiError
+from content_store import content_hash
+from spool import Spool
+
+
+class PersistWorker:
+    """
+    @startdoc
+    @overview Uploads persisted files on a background thread so saving never waits on the network.
+    @details Pending uploads are keyed by (repo, branch, path): saving the same file again before its
+    upload starts replaces the queued contents instead of queueing a second upload. Failed uploads are
+    retried with exponential backoff, and their outcome is collected for Vim to poll from its main thread.
+    With a spool, uploads that still can't reach Docstring are spooled rather than dropped, and drained in
+    batches whenever no live save is waiting, backing off while Docstring stays unreachable.
+    @end
+    """
+
+    def __init__(self, upload: Callable[[Hashable, dict], None], max_pending: int = 64, retries: int = 3, backoff: float = 0.5,
+                 spool: Optional[Spool] = None, drain_batch: int = 16, offline_backoff: float = 30.0, max_offline_backoff: float = 300.0):
+        """
+        :param upload: Called on the worker thread with each key and job, raises on failure
+        :param max_pending: How many distinct files can be waiting to upload at once
+        :param retries: How many times a failed upload is retried
+        :param backoff: Delay before the first retry, doubled for each one after
+        :param spool: Where uploads that can't reach Docstring are kept until it can be reached
+        :param drain_batch: How many spooled uploads are read at once
+        :param offline_backoff: Delay before trying the spool again while Docstring can't be reached, doubled each time
+        :param max_offline_backoff: Longest delay between two tries of the spool
+        """
+        self._upload = upload
+        self.max_pending = max_pending
+        self.retries = retries
+        self.backoff = backoff
+        self.spool = spool
+        self.drain_batch = drain_batch
+        self.offline_backoff = offline_backoff
+        self.max_offline_backoff = max_offline_backoff
+
+        self._cond = threading.Condition()
+        self._pending: 'OrderedDict[Hashable, dict]' = OrderedDict()
+        self._in_flight: Dict[Hashable, dict] = {}
+        self._results: 'queue.Queue[Tuple[int, str]]' = queue.Queue()
+        self._thread = None
+
+        # When the spool is next drained, None while it's empty. Only touched on the worker thread.
+        self._drain_at: Optional[float] = None
+        self._offline_delay = offline_backoff
+
+    def submit(self, key: Hashable, job: dict) -> bool:
+        """
+        @startdoc
+        Queues a job for upload, coalescing it with any queued job for the same key.
+        Returns False if the queue is full.
+        @end
+        """
+        with self._cond:
+            if key not in self._pending and len(self._pending) >= self.max_pending:
+                return False
+            self._pending[key] = job
+            self._cond.notify()
+            self._start()
+        return True
+
+    def start(self):
+        """
+        @startdoc
+        Starts the worker thread, which otherwise starts with the first upload, so anything spooled gets drained
+        @end
+        """
+        with self._cond:
+            self._start()
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='docstring-persist', daemon=True)
+            self._thread.start()
+
+    def spool_pending(self):
+        """
+        @startdoc
+        Spools every upload queued or running, for when Vim exits before they are done
+        @end
+        """
+        if self.spool is None:
+            return
+        with self._cond:
+            jobs = list(self._in_flight.items()) + list(self._pending.items())
+        for key, job in jobs:
+            self.spool.add(key, job)
+
+    def busy(self) -> bool:
+        """
+        @startdoc
+        Whether there are uploads queued or running, or results waiting to be polled. Spooled uploads don't count.
+        @end
+        """
+        with self._cond:
+            return bool(self._pending) or bool(self._in_flight) or not self._results.empty()
+
+    def has_work_for(self, key: Hashable) -> bool:
+        """
+        @startdoc
+        Whether an upload for a key is queued or running
+        @end
+        """
+        with self._cond:
+            return key in self._pending or key in self._in_flight
+
+    def poll(self) -> List[Tuple[int, str]]:
+        """
+        @startdoc
+        Returns the (log level, message) results produced since the last poll
+        @end
+        """
+        results = []
+        while True:
+            try:
+                results.append(self._results.get_nowait())
+            except queue.Empty:
+                return results
+
+    def _superseded(self, key: Hashable) -> bool:
+        with self._cond:
+            return key in self._pending
+
+    def _drain_due(self) -> bool:
+        return self._drain_at is not None and time.monotonic() >= self._drain_at
+
+    def _run(self):
+        if self.spool is not None and len(self.spool):
+            self._drain_at = time.monotonic()
+
+        while True:
+            with self._cond:
+                while not self._pending and not self._drain_due():
+                    self._cond.wait(None if self._drain_at is None else self._drain_at - time.monotonic())
+                if not self._pending:
+                    key = None
+                else:
+                    key, job = self._pending.popitem(last=False)
+                    self._in_flight[key] = job
+
+            if key is None:
+                self._drain()
+                continue
+
+            try:
+                if self._attempt(key, job, self.retries):
+                    self._uploaded(key)
+                elif self.spool is not None:
+                    self._spool(key, job)
+            except Exception as e:
+                logging.exception('Persist worker failed')
+                self._results.put((logging.ERROR, f'Docstring: Error saving: {e}'))
+            finally:
+                with self._cond:
+                    self._in_flight.pop(key, None)
+
+    def _uploaded(self, key: Hashable):
+        """
+        Drops an older spooled version of a file that was just uploaded, which also means Docstring is back
+        """
+        if self.spool is None or self._drain_at is None:
+            return
+        self.spool.discard(key)
+        self._offline_delay = self.offline_backoff
+        self._drain_at = time.monotonic() if self.spool.exists() else None
+
+    def _spool(self, key: Hashable, job: dict):
+        self.spool.add(key, job)
+        self._results.put((logging.INFO, f'Docstring: Will save {job["filename"]} once Docstring can be reached'))
+        if self._drain_at is None:
+            self._drain_at = time.monotonic() + self._offline_delay
+
+    def _drain(self):
+        """
+        Uploads a batch of spooled jobs, oldest first, giving way to live saves as soon as one is queued
+        """
+        entries = self.spool.take(self.drain_batch)
+        if not entries:
+            self._drain_at = None
+            return
+
+        uploaded = 0
+        for key, job in entries:
+            with self._cond:
+                if self._pending:
+                    break
+                self._in_flight[key] = job
+            try:
+                reached = self._attempt(key, job, 0)
+            finally:
+                with self._cond:
+                    self._in_flight.pop(key, None)
+
+            if not reached:
+                self._drain_at = time.monotonic() + self._offline_delay
+                self._offline_delay = min(self._offline_delay * 2, self.max_offline_backoff)
+                break
+            # Unless a newer version of the file got spooled meanwhile
+            self.spool.discard(key, content_hash(job['content']))
+            uploaded += 1
+        else:
+            self._offline_delay = self.offline_backoff
+            self._drain_at = time.monotonic()
+
+        if uploaded:
+            self._results.put((logging.INFO, f'Docstring: Saved {uploaded} files changed while Docstring could not be reached'))
+
+    def _attempt(self, key: Hashable, job: dict, retries: int) -> bool:
+        """
+        Uploads a job, retrying on network and server errors. Returns False if Docstring couldn't be reached.
+        """
+        delay = self.backoff
+        for attempt in range(retries + 1):
+            try:
+                self._upload(key, job)
+                return True
+            except ApiError as e:
+                if e.status < 500:
+                    self._results.put((logging.ERROR, f'Docstring: Error saving: {e.body}'))
+                    return True
+                if attempt == retries:
+                    if self.spool is None:
+                        self._results.put((logging.ERROR, f'Docstring: Error saving: {e.body}'))
+                    return False
+            except (OSError, http.client.HTTPException) as e:
+                if attempt == retries:
+                    if self.spool is None:
+                        self._results.put((logging.INFO, f'Docstring: Could not reach Docstring to save {job["filename"]}: {e}'))
+                    return False
+
+            time.sleep(delay)
+            delay *= 2
+
+            # A newer save of the same file is queued, uploading this one is pointless
+            if self._superseded(key):
+                return True
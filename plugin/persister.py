@@ -0,0 +1,109 @@
+#@docstring
+from typing import Tuple
+
+import json
+import pathlib
+
+from api_client import ApiClient, ApiError
+from content_store import ContentStore, content_hash, line_delta
+
+
+API_ENDPOINT = '/api/integrations/vscode'
+
+# Timeout so that a hung connection doesn't hold up the uploads queued behind it
+PERSIST_TIMEOUT = 5
+
+# Skip the compression round trip for bodies that would barely shrink
+GZIP_MIN_SIZE = 1024
+
+
+def make_job(repo: str, branch: str, relative_file: pathlib.Path, content: str) -> Tuple[tuple, dict]:
+    """
+    @startdoc
+    Builds the key and upload job persisting a file, relative to its repository root, on a branch
+    @end
+    """
+    if relative_file.name.lower() == 'readme.md':
+        endpoint = API_ENDPOINT + '/readme/persist'
+    else:
+        endpoint = API_ENDPOINT + '/docs/persist'
+
+    return (repo, branch, str(relative_file)), {
+        'endpoint': endpoint,
+        'content': content,
+        'filename': relative_file.name,
+        'path': str(relative_file.parent),
+        'branch': branch,
+        'repo': repo,
+    }
+
+
+class Persister:
+    """
+    @startdoc
+    @overview Uploads persist jobs to Docstring, sending as little as possible. Safe to call from several threads.
+    @details Contents identical to the last acknowledged upload are skipped. Otherwise a line delta against
+    the last acknowledged version is sent when it is smaller than the file, falling back to the full contents.
+    @end
+    """
+
+    def __init__(self, client: ApiClient, store: ContentStore):
+        self.client = client
+        self.store = store
+
+        # Delta uploads and gzip bodies are switched off the first time
+        # the API rejects them, falling back to a plain full upload
+        self.server_accepts = {
+            'delta': True,
+            'gzip': True,
+        }
+
+    def upload(self, key: tuple, job: dict) -> bool:
+        """
+        @startdoc
+        Sends a persist job, returning False if it was skipped because nothing changed
+        @end
+        """
+        content = job['content']
+        digest = content_hash(content)
+
+        last = self.store.get(key)
+        if last is not None and last[0] == digest:
+            return False
+
+        body = {
+            'filename': job['filename'],
+            'path': job['path'],
+            'branch': job['branch'],
+            'repo': job['repo'],
+            'content_hash': digest,
+        }
+
+        if last is not None and self.server_accepts['delta']:
+            delta = line_delta(last[1], content)
+            if len(json.dumps(delta)) < len(content) // 2:
+                try:
+                    self.client.post_json(job['endpoint'], dict(body, base_hash=last[0], delta=delta),
+                                          self.server_accepts['gzip'], PERSIST_TIMEOUT)
+                    self.store.put(key, content)
+                    return True
+                except ApiError as e:
+                    # A server error is left for the worker to retry. 409 means the server no longer
+                    # has our base, and only a rejected body means it doesn't do deltas.
+                    if e.status >= 500:
+                        raise
+                    if e.status in (400, 415, 422):
+                        self.server_accepts['delta'] = False
+
+        body['content'] = content  # TODO: figure out line ending from mode?
+        compress = self.server_accepts['gzip'] and len(content) >= GZIP_MIN_SIZE
+        try:
+            self.client.post_json(job['endpoint'], body, compress, PERSIST_TIMEOUT)
+        except ApiError as e:
+            if not compress or e.status not in (400, 415):
+                raise
+            self.server_accepts['gzip'] = False
+            self.client.post_json(job['endpoint'], body, False, PERSIST_TIMEOUT)
+
+        self.store.put(key, content)
+        return True
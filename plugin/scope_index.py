@@ -0,0 +1,99 @@
+#@docstring
+from typing import List
+
+import bisect
+
+
+class FenwickTree:
+    """
+    @startdoc
+    @overview A binary indexed tree over integers, supporting point updates and prefix sums in O(log n).
+    @end
+    """
+
+    def __init__(self, values: List[int]):
+        # Built in O(n) by pushing each node's total to its parent
+        self._tree = [0] + list(values)
+        size = len(self._tree)
+        for i in range(1, size):
+            parent = i + (i & -i)
+            if parent < size:
+                self._tree[parent] += self._tree[i]
+
+    def __len__(self) -> int:
+        return len(self._tree) - 1
+
+    def add(self, i: int, delta: int):
+        """
+        @startdoc
+        Adds delta to the value at index i
+        @end
+        """
+        i += 1
+        size = len(self._tree)
+        while i < size:
+            self._tree[i] += delta
+            i += i & -i
+
+    def prefix_sum(self, i: int) -> int:
+        """
+        @startdoc
+        Returns the sum of the values at indexes 0 to i, inclusive
+        @end
+        """
+        total = 0
+        i += 1
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+
+class ScopeIndex:
+    """
+    @startdoc
+    @overview Tracks where each scope's docs currently are in the buffer while they are being generated.
+    @details Anchors are the original lines docs are inserted at, sorted. Lines added to or removed from
+    the buffer shift every anchor after them, which is recorded as a single Fenwick tree update, so
+    mapping an anchor to its current line and shifting all the anchors after a point are both O(log n).
+    @end
+    """
+
+    def __init__(self, anchors: List[int], spacing: int = 0):
+        """
+        :param anchors: Sorted, distinct original line numbers
+        :param spacing: Lines already inserted at each anchor, shifting every anchor after it
+        """
+        self.anchors = anchors
+        self._shifts = FenwickTree([0] + [spacing] * (len(anchors) - 1) if anchors else [])
+
+    def __len__(self) -> int:
+        return len(self.anchors)
+
+    def find(self, anchor: int) -> int:
+        """
+        @startdoc
+        Returns the position of an original line in the index, raising KeyError if it isn't an anchor
+        @end
+        """
+        i = bisect.bisect_left(self.anchors, anchor)
+        if i == len(self.anchors) or self.anchors[i] != anchor:
+            raise KeyError(anchor)
+        return i
+
+    def line(self, i: int) -> int:
+        """
+        @startdoc
+        Returns the current line of the i-th anchor
+        @end
+        """
+        return self.anchors[i] + self._shifts.prefix_sum(i)
+
+    def shift_from(self, i: int, delta: int):
+        """
+        @startdoc
+        Moves the i-th anchor and every anchor after it by delta lines
+        @end
+        """
+        if i < len(self.anchors) and delta:
+            self._shifts.add(i, delta)
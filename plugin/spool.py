@@ -0,0 +1,310 @@
+#@docstring
+from collections import OrderedDict
+from typing import Hashable, List, Optional, Tuple
+
+import contextlib
+import fcntl
+import itertools
+import json
+import logging
+import os
+import pathlib
+import tempfile
+import threading
+import uuid
+
+from content_store import content_hash
+
+
+# Compact once the file is this many times bigger than the entries still in it
+COMPACT_RATIO = 2
+COMPACT_MIN_SIZE = 1024 * 1024
+
+
+class Spool:
+    """
+    @startdoc
+    @overview A durable queue of persist jobs that couldn't be uploaded, replayed once Docstring can be reached again.
+    @details Entries are appended to a JSON-lines file, one per job, and removals are appended as tombstones, so
+    every write is a single append. Only the latest job per key is live: the file is compacted into a fresh copy
+    holding just those, replaced atomically, once it is mostly dead entries. A crash can at worst leave a torn last
+    line, which is skipped. Live entries are bounded by max_bytes, beyond which the oldest are dropped.
+    Every Vim session shares the file, so each operation holds an flock on a lock file next to it, and first
+    catches up with whatever other sessions appended, or reloads the file if one of them replaced it. Replacements
+    are told apart by a random header line each new file starts with, as inode numbers get reused.
+    @end
+    """
+
+    def __init__(self, path: pathlib.Path, max_bytes: int = 64 * 1024 * 1024):
+        """
+        :param path: The spool file, created when the first job is added
+        :param max_bytes: How big the live entries can get before the oldest are dropped
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._loaded = False
+        # key -> (offset, length, hash) of its live entry, oldest first
+        self._index: 'OrderedDict[Hashable, Tuple[int, int, str]]' = OrderedDict()
+        self._live = 0
+        # The header and size of the file as last read or written here, None if there was no file
+        self._seen: Optional[Tuple[bytes, int]] = None
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(str(self.path) + '.lock', 'a') as lock:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    def exists(self) -> bool:
+        """
+        @startdoc
+        Whether there may be anything spooled, by this session or another, without reading the spool
+        @end
+        """
+        return self.path.exists()
+
+    def __len__(self) -> int:
+        with self._locked():
+            self._sync()
+            return len(self._index)
+
+    def _sync(self):
+        """
+        Brings the index up to date with the file: replays only what was appended since it was last seen if it's
+        the same file, or all of it if another session replaced it
+        """
+        try:
+            f = open(str(self.path), 'rb')
+        except FileNotFoundError:
+            self._index = OrderedDict()
+            self._live = 0
+            self._seen = None
+            self._loaded = True
+            return
+
+        try:
+            with f:
+                header = f.readline()
+                size = os.fstat(f.fileno()).st_size
+                if self._loaded and self._seen is not None and self._seen[0] == header and self._seen[1] <= size:
+                    start = self._seen[1]
+                    if start == size:
+                        return
+                else:
+                    start = 0
+                    self._index = OrderedDict()
+                    self._live = 0
+                f.seek(start)
+                data = f.read()
+        except OSError as e:
+            logging.error(f'Docstring: Could not read the upload spool: {e}')
+            return
+
+        offset = 0
+        while True:
+            end = data.find(b'\n', offset)
+            if end < 0:
+                break
+            self._replay(data[offset:end + 1], start + offset)
+            offset = end + 1
+        # Anything after the last newline is a torn append, which the next one ends so it's skipped
+        self._seen = (header, start + len(data))
+
+        first_load = not self._loaded
+        self._loaded = True
+        if first_load:
+            self._bound()
+
+    def _replay(self, line: bytes, offset: int):
+        try:
+            record = json.loads(line.decode('utf-8'))
+            key = tuple(record['key'])
+        except (ValueError, KeyError, TypeError):
+            return
+
+        old = self._index.pop(key, None)
+        if old is not None:
+            self._live -= old[1]
+
+        if 'job' in record:
+            self._index[key] = (offset, len(line), record['hash'])
+            self._live += len(line)
+
+    @staticmethod
+    def _header() -> bytes:
+        return (json.dumps({'spool': uuid.uuid4().hex}) + '\n').encode('utf-8')
+
+    def _append(self, record: dict) -> Tuple[int, int]:
+        """
+        Appends a record durably, returning the offset and length of its line
+        """
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        with open(str(self.path), 'a+b') as f:
+            size = f.seek(0, os.SEEK_END)
+            f.seek(0)
+            header = f.readline()
+            # Only caught up afterwards if this session had read everything up to here
+            caught_up = self._loaded and self._seen in (None, (header, size))
+
+            if not size:
+                header = self._header()
+                f.write(header)
+                size = len(header)
+            else:
+                f.seek(size - 1)
+                if f.read(1) != b'\n':
+                    # Ends the torn line of a crashed append, so it's skipped as a whole
+                    f.write(b'\n')
+                    size += 1
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+        if caught_up:
+            self._seen = (header, size + len(line))
+        return size, len(line)
+
+    def add(self, key: Hashable, job: dict):
+        """
+        @startdoc
+        Spools a job, replacing any spooled before for the same key. The spool isn't read just to add to it.
+        @end
+        """
+        digest = content_hash(job['content'])
+        with self._locked():
+            if self._loaded:
+                self._sync()
+            try:
+                offset, length = self._append({'key': list(key), 'hash': digest, 'job': job})
+            except OSError as e:
+                logging.error(f'Docstring: Could not spool an upload: {e}')
+                return
+            if not self._loaded:
+                return
+
+            old = self._index.pop(key, None)
+            if old is not None:
+                self._live -= old[1]
+            self._index[key] = (offset, length, digest)
+            self._live += length
+
+            self._bound()
+
+    def discard(self, key: Hashable, digest: Optional[str] = None):
+        """
+        @startdoc
+        Removes the spooled job for a key, only if its contents have that hash when one is given
+        @end
+        """
+        if not self._loaded and not self.path.exists():
+            return
+
+        with self._locked():
+            self._sync()
+
+            entry = self._index.get(key)
+            if entry is None or (digest is not None and entry[2] != digest):
+                return
+            try:
+                self._append({'key': list(key), 'hash': entry[2]})
+            except OSError as e:
+                logging.error(f'Docstring: Could not update the upload spool: {e}')
+                return
+
+            del self._index[key]
+            self._live -= entry[1]
+
+            if not self._index:
+                self._compact()
+            else:
+                self._bound()
+
+    def take(self, count: int) -> List[Tuple[Hashable, dict]]:
+        """
+        @startdoc
+        Returns up to count of the oldest spooled (key, job) pairs, leaving them spooled until discarded
+        @end
+        """
+        with self._locked():
+            self._sync()
+            entries = []
+            if not self._index:
+                return entries
+
+            try:
+                with open(str(self.path), 'rb') as f:
+                    for key, (offset, length, _) in itertools.islice(self._index.items(), count):
+                        f.seek(offset)
+                        record = json.loads(f.read(length).decode('utf-8'))
+                        entries.append((key, record['job']))
+            except (OSError, ValueError) as e:
+                logging.error(f'Docstring: Could not read the upload spool: {e}')
+            return entries
+
+    def _bound(self):
+        """
+        Drops the oldest entries once the live ones are over max_bytes, and compacts once the file is mostly dead
+        """
+        dropped = 0
+        if self._live > self.max_bytes:
+            # Down to three quarters, so a full spool isn't rewritten on every add
+            while self._live > self.max_bytes * 3 // 4 and len(self._index) > 1:
+                _, (_, length, _) = self._index.popitem(last=False)
+                self._live -= length
+                dropped += 1
+        if dropped:
+            logging.warning(f'Docstring: Upload spool full, dropped the {dropped} oldest saves')
+
+        size = self._seen[1] if self._seen is not None else 0
+        if dropped or (size > COMPACT_MIN_SIZE and size > COMPACT_RATIO * self._live):
+            self._compact()
+
+    def _compact(self):
+        """
+        Rewrites the spool with only its live entries, replacing it atomically. The lock is held and the index
+        is in sync with the file, so no other session's entries can be lost.
+        """
+        if not self._index:
+            try:
+                os.unlink(str(self.path))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.error(f'Docstring: Could not compact the upload spool: {e}')
+                return
+            self._live = 0
+            self._seen = None
+            return
+
+        index = OrderedDict()
+        tmp = None
+        try:
+            fd, tmp = tempfile.mkstemp(dir=str(self.path.parent), suffix='.tmp')
+            with open(str(self.path), 'rb') as old, os.fdopen(fd, 'wb') as new:
+                header = self._header()
+                new.write(header)
+                offset = len(header)
+                for key, (old_offset, length, digest) in self._index.items():
+                    old.seek(old_offset)
+                    new.write(old.read(length))
+                    index[key] = (offset, length, digest)
+                    offset += length
+                new.flush()
+                os.fsync(new.fileno())
+            os.replace(tmp, str(self.path))
+        except OSError as e:
+            logging.error(f'Docstring: Could not compact the upload spool: {e}')
+            if tmp is not None and os.path.exists(tmp):
+                os.unlink(tmp)
+            return
+
+        self._index = index
+        self._live = offset - len(header)
+        self._seen = (header, offset)
@@ -0,0 +1,139 @@
+#@docstring
+from collections import deque
+from typing import Callable, Dict, List, Optional
+
+import json
+import threading
+import time
+
+
+class Histogram:
+    """
+    @startdoc
+    @overview Keeps the most recent samples of a measurement and reports their percentiles.
+    @end
+    """
+
+    def __init__(self, unit: str, size: int = 1024):
+        self.unit = unit
+        self.count = 0
+        self._samples = deque(maxlen=size)
+
+    def add(self, value: float):
+        """
+        @startdoc
+        Records a sample, dropping the oldest one once the window is full
+        @end
+        """
+        self.count += 1
+        self._samples.append(value)
+
+    def percentiles(self, *ps: float) -> List[float]:
+        """
+        @startdoc
+        Returns the nearest-rank percentiles of the samples in the window, one per p between 0 and 100
+        @end
+        """
+        ordered = sorted(self._samples)
+        if not ordered:
+            return [0.0 for _ in ps]
+        return [ordered[min(len(ordered) - 1, max(0, int(len(ordered) * p / 100 + 0.5) - 1))] for p in ps]
+
+
+class Stats:
+    """
+    @startdoc
+    @overview Collects how long each phase of persisting and generating docs takes.
+    @details Samples go into per-name rolling histograms and, if a trace file is set, are appended to it as JSON lines.
+    With a sink, as in the proxy, they are handed to it instead. Disabled, which is the default, start() and stop()
+    do nothing but check a flag.
+    @end
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.sink: Optional[Callable[[str, float, str, dict], None]] = None
+
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, Histogram] = {}
+        self._trace_path: Optional[str] = None
+        self._trace = None
+
+    def configure(self, enabled: bool, trace_path: Optional[str] = None):
+        """
+        @startdoc
+        Turns collection on or off, a trace file turning it on
+        @end
+        """
+        with self._lock:
+            if self._trace is not None and trace_path != self._trace_path:
+                self._trace.close()
+                self._trace = None
+            self._trace_path = trace_path or None
+            self.enabled = bool(enabled or trace_path)
+
+    def start(self) -> float:
+        """
+        @startdoc
+        Returns the time a phase starts at, to pass to stop()
+        @end
+        """
+        return time.perf_counter() if self.enabled else 0.0
+
+    def stop(self, name: str, started: float, **fields):
+        """
+        @startdoc
+        Records how many milliseconds passed since start()
+        @end
+        """
+        if self.enabled:
+            self.record(name, (time.perf_counter() - started) * 1000, **fields)
+
+    def record(self, name: str, value: float, unit: str = 'ms', **fields):
+        """
+        @startdoc
+        Records a sample. Extra fields, such as the request id, only go to the trace file.
+        @end
+        """
+        if not self.enabled:
+            return
+
+        if self.sink is not None:
+            self.sink(name, value, unit, fields)
+            return
+
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram(unit)
+            histogram.add(value)
+
+            if self._trace_path is not None:
+                self._write_trace(dict(fields, time=time.time(), name=name, value=round(value, 3), unit=unit))
+
+    def _write_trace(self, sample: dict):
+        try:
+            if self._trace is None:
+                self._trace = open(self._trace_path, 'a', buffering=1)
+            self._trace.write(json.dumps(sample) + '\n')
+        except OSError:
+            # A trace file that can't be written isn't worth breaking saves over
+            self._trace_path = None
+
+    def summary(self) -> List[str]:
+        """
+        @startdoc
+        Returns one line per measurement with its sample count and p50, p95 and p99
+        @end
+        """
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            lines = []
+            for name, histogram in histograms:
+                p50, p95, p99 = histogram.percentiles(50, 95, 99)
+                lines.append(f'{name:<28} n={histogram.count:<6} p50={p50:.1f} p95={p95:.1f} p99={p99:.1f} {histogram.unit}')
+        return lines
+
+
+# Shared by everything in the process
+stats = Stats()
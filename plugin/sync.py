@@ -0,0 +1,156 @@
+#@docstring
+"""
+Uploads every Docstring file in a repository, or only the ones touched by some commits.
+
+    API_KEY=... python3 sync.py [--commit REV]... [--since REV] [--json] [REPO]
+
+With no options every tracked README.md and @docstring file is uploaded. From a
+post-commit hook use `--commit HEAD`, and from a post-merge hook `--since ORIG_HEAD`.
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional
+
+import argparse
+import http.client
+import json
+import os
+import pathlib
+import sys
+import time
+
+from api_client import API_HOST, ApiClient, ApiError
+from common import (
+    get_cache_dir,
+    get_docstring_files,
+    get_files_changed_since,
+    get_files_in_commit,
+    get_repo_metadata,
+)
+from content_store import ContentStore
+from persister import Persister, make_job
+
+
+# Uploads run in parallel over this many kept-alive connections
+DEFAULT_CONCURRENCY = 16
+
+
+def read_persisted_contents(path: pathlib.Path) -> Optional[str]:
+    """
+    @startdoc
+    Reads a file the way Vim would persist it, None if it shouldn't be persisted.
+    Vim joins buffer lines without the final newline, so it's dropped here too and hashes match across both.
+    @end
+    """
+    try:
+        contents = path.read_bytes().decode('utf-8')
+    except (OSError, UnicodeDecodeError):
+        return None
+
+    if contents.endswith('\n'):
+        contents = contents[:-1]
+    if path.name.lower() != 'readme.md' and '@docstring' not in contents:
+        return None
+    return contents
+
+
+def sync(repo_path: str, files: List[str], concurrency: int = DEFAULT_CONCURRENCY, report=None) -> dict:
+    """
+    @startdoc
+    @overview Uploads files, relative to the repository root, through a bounded pool of workers.
+    @details Files unchanged since their last acknowledged upload are skipped without a request. Files that
+    can't be read, or aren't Docstring files, are counted as ignored. report is called with the running
+    totals after each file.
+    @end
+    """
+    metadata = get_repo_metadata(repo_path)
+    if metadata is None:
+        raise ValueError(f'{repo_path} is not in a git repository')
+
+    repo = metadata.root.name
+    branch = metadata.branch()
+
+    client = ApiClient(API_HOST, os.environ['API_KEY'], max_connections=concurrency)
+    persister = Persister(client, ContentStore(get_cache_dir() / 'persisted'))
+
+    totals = {'total': len(files), 'done': 0, 'uploaded': 0, 'skipped': 0, 'ignored': 0, 'failed': 0, 'errors': []}
+
+    def upload(fn: str) -> str:
+        contents = read_persisted_contents(metadata.root / fn)
+        if contents is None:
+            return 'ignored'
+        return 'uploaded' if persister.upload(*make_job(repo, branch, pathlib.Path(fn), contents)) else 'skipped'
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(upload, fn): fn for fn in files}
+        for future in as_completed(futures):
+            totals['done'] += 1
+            try:
+                totals[future.result()] += 1
+            except (ApiError, OSError, http.client.HTTPException) as e:
+                totals['failed'] += 1
+                totals['errors'].append(f'{futures[future]}: {e}')
+
+            if report is not None:
+                report(totals)
+
+    client.close()
+    return totals
+
+
+def main(argv: List[str]):
+    parser = argparse.ArgumentParser(description='Upload Docstring files in a git repository.')
+    parser.add_argument('repo', nargs='?', default='.', help='path inside the repository, defaults to the current directory')
+    parser.add_argument('--commit', action='append', default=[], help='only upload files touched by this commit, may be repeated')
+    parser.add_argument('--since', help='only upload files changed between this revision and HEAD')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY, help='uploads in flight at once')
+    parser.add_argument('--json', action='store_true', help='report progress as JSON lines, as used by Vim')
+    args = parser.parse_args(argv)
+
+    metadata = get_repo_metadata(os.path.abspath(args.repo))
+    if metadata is None:
+        parser.error(f'{args.repo} is not in a git repository')
+    root = str(metadata.root)
+
+    if args.commit or args.since:
+        touched = set()
+        for commit in args.commit:
+            touched.update(get_files_in_commit(root, commit))
+        if args.since:
+            touched.update(get_files_changed_since(root, args.since))
+        # Deleted files are in the diff too
+        files = sorted(fn for fn in touched if metadata.is_tracked(fn) and (metadata.root / fn).is_file())
+    else:
+        files = get_docstring_files(root)
+
+    started = time.monotonic()
+    last_report = [0.0]
+
+    def report(totals: dict):
+        now = time.monotonic()
+        if now - last_report[0] < 0.1 and totals['done'] != totals['total']:
+            return
+        last_report[0] = now
+
+        if args.json:
+            print(json.dumps({'type': 'progress', **{k: v for k, v in totals.items() if k != 'errors'}}), flush=True)
+        else:
+            sys.stderr.write(f"\r{totals['done']}/{totals['total']} files, {totals['failed']} failed")
+            sys.stderr.flush()
+
+    totals = sync(root, files, args.concurrency, report)
+    elapsed = time.monotonic() - started
+
+    if args.json:
+        print(json.dumps({'type': 'done', 'elapsed': round(elapsed, 3), **totals}), flush=True)
+    else:
+        sys.stderr.write('\n')
+        for error in totals['errors']:
+            print(f'Docstring: Error saving {error}', file=sys.stderr)
+        print(f"Docstring: {totals['uploaded']} uploaded, {totals['skipped']} unchanged, "
+              f"{totals['ignored']} ignored, {totals['failed']} failed in {elapsed:.1f}s")
+
+    return 1 if totals['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
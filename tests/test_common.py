@@ -0,0 +1,174 @@
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'plugin'))
+
+import common
+from common import get_current_branch, get_files_in_commit, get_repo_root, is_file_tracked, parse_index
+
+
+GIT_ENV = dict(
+    os.environ,
+    GIT_AUTHOR_NAME='test', GIT_AUTHOR_EMAIL='test@localhost',
+    GIT_COMMITTER_NAME='test', GIT_COMMITTER_EMAIL='test@localhost',
+    GIT_CONFIG_NOSYSTEM='1', HOME=tempfile.gettempdir(),
+)
+GIT_ENV.pop('GIT_DIR', None)
+
+
+def git(repo: pathlib.Path, *args: str) -> str:
+    return subprocess.check_output(['git', '-C', str(repo)] + list(args), env=GIT_ENV, stderr=subprocess.STDOUT).decode('utf-8')
+
+
+def ls_files(repo: pathlib.Path) -> set:
+    return set(os.fsencode(fn) for fn in git(repo, 'ls-files', '-z').split('\0')[:-1])
+
+
+class RepoTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.repo = pathlib.Path(os.path.realpath(self.tmp.name)) / 'repo'
+        self.repo.mkdir()
+        git(self.repo, 'init', '-q', '-b', 'main')
+        for fn in ('README.md', 'a.py', 'sub/b.py', 'sub/deeper/c.py', 'other/d.txt'):
+            path = self.repo / fn
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(f'{fn}\n')
+        git(self.repo, 'add', '.')
+        git(self.repo, 'commit', '-q', '-m', 'init')
+
+    def tearDown(self):
+        common._repos.clear()
+        common._repo_roots.clear()
+        self.tmp.cleanup()
+
+    def index(self) -> bytes:
+        return (self.repo / '.git' / 'index').read_bytes()
+
+    def assert_all_tracked(self, repo: pathlib.Path = None):
+        repo = repo or self.repo
+        for fn in ls_files(repo):
+            self.assertTrue(is_file_tracked(str(repo), os.fsdecode(fn)), fn)
+        self.assertFalse(is_file_tracked(str(repo), 'missing.py'))
+
+    def test_index_v2(self):
+        git(self.repo, 'update-index', '--index-version', '2')
+        self.assertEqual(parse_index(self.index()), ls_files(self.repo))
+        self.assert_all_tracked()
+
+    def test_index_v3(self):
+        # Intent-to-add entries have the extended flags only version 3 can store
+        (self.repo / 'new.py').write_text('new\n')
+        git(self.repo, 'add', '-N', 'new.py')
+        git(self.repo, 'update-index', '--index-version', '3')
+        self.assertEqual(self.index()[4:8], b'\0\0\0\3')
+        self.assertEqual(parse_index(self.index()), ls_files(self.repo))
+        self.assert_all_tracked()
+
+    def test_index_v4(self):
+        git(self.repo, 'update-index', '--index-version', '4')
+        self.assertEqual(self.index()[4:8], b'\0\0\0\4')
+        self.assertEqual(parse_index(self.index()), ls_files(self.repo))
+        self.assert_all_tracked()
+
+    def test_index_with_extensions(self):
+        # Writes a cache tree extension
+        git(self.repo, 'write-tree')
+        self.assertEqual(parse_index(self.index()), ls_files(self.repo))
+
+    def test_split_index_falls_back_to_ls_files(self):
+        git(self.repo, 'update-index', '--split-index')
+        (self.repo / 'n.txt').write_text('n\n')
+        git(self.repo, 'add', 'n.txt')
+
+        with self.assertRaises(ValueError):
+            parse_index(self.index())
+        self.assertIn(b'n.txt', ls_files(self.repo))
+        self.assert_all_tracked()
+
+    def test_sparse_index_falls_back_to_ls_files(self):
+        try:
+            git(self.repo, 'sparse-checkout', 'init', '--cone', '--sparse-index')
+            git(self.repo, 'sparse-checkout', 'set', 'sub')
+        except subprocess.CalledProcessError as e:
+            self.skipTest(f'git without sparse index support: {e.output}')
+
+        with self.assertRaises(ValueError):
+            parse_index(self.index())
+        self.assertTrue(is_file_tracked(str(self.repo), 'sub/b.py'))
+        self.assertTrue(is_file_tracked(str(self.repo), 'other/d.txt'))
+
+    def test_branch(self):
+        self.assertEqual(get_current_branch(str(self.repo)), 'main')
+        git(self.repo, 'checkout', '-q', '-b', 'feature/x')
+        self.assertEqual(get_current_branch(str(self.repo)), 'feature/x')
+
+    def test_detached_head(self):
+        git(self.repo, 'checkout', '-q', '--detach')
+        self.assertEqual(get_current_branch(str(self.repo)), 'HEAD')
+
+    def test_worktree(self):
+        worktree = self.repo.parent / 'worktree'
+        git(self.repo, 'worktree', 'add', '-q', '-b', 'wt', str(worktree))
+        (worktree / 'only_here.py').write_text('x\n')
+        git(worktree, 'add', 'only_here.py')
+
+        self.assertEqual(get_repo_root(str(worktree / 'sub' / 'b.py')), worktree)
+        self.assertEqual(get_current_branch(str(worktree)), 'wt')
+        self.assertEqual(get_current_branch(str(self.repo)), 'main')
+        self.assertTrue(is_file_tracked(str(worktree), 'only_here.py'))
+        self.assertFalse(is_file_tracked(str(self.repo), 'only_here.py'))
+        self.assert_all_tracked(worktree)
+
+    def test_repo_root_from_subdirectory(self):
+        self.assertEqual(get_repo_root(str(self.repo / 'sub' / 'deeper' / 'c.py')), self.repo)
+        self.assertIsNone(get_repo_root(str(self.repo.parent / 'elsewhere.py')))
+
+    def test_index_changes_invalidate_the_cache(self):
+        self.assertFalse(is_file_tracked(str(self.repo), 'later.py'))
+
+        # Make sure the index mtime moves even on filesystems with coarse timestamps
+        time.sleep(0.01)
+        (self.repo / 'later.py').write_text('later\n')
+        git(self.repo, 'add', 'later.py')
+        self.assertTrue(is_file_tracked(str(self.repo), 'later.py'))
+
+        git(self.repo, 'rm', '-q', '--cached', 'a.py')
+        self.assertFalse(is_file_tracked(str(self.repo), 'a.py'))
+
+    def test_files_in_commit(self):
+        self.assertEqual(sorted(get_files_in_commit(str(self.repo), 'HEAD')),
+                         ['README.md', 'a.py', 'other/d.txt', 'sub/b.py', 'sub/deeper/c.py'])
+
+        (self.repo / 'a.py').write_text('changed\n')
+        (self.repo / 'new file.py').write_text('new\n')
+        git(self.repo, 'add', '.')
+        git(self.repo, 'commit', '-q', '-m', 'change')
+        self.assertEqual(sorted(get_files_in_commit(str(self.repo), 'HEAD')), ['a.py', 'new file.py'])
+
+    def test_files_in_merge_are_compared_to_the_first_parent(self):
+        git(self.repo, 'checkout', '-q', '-b', 'side')
+        (self.repo / 'z.py').write_text('z\n')
+        git(self.repo, 'add', 'z.py')
+        git(self.repo, 'commit', '-q', '-m', 'side')
+        git(self.repo, 'checkout', '-q', 'main')
+        (self.repo / 'y.py').write_text('y\n')
+        git(self.repo, 'add', 'y.py')
+        git(self.repo, 'commit', '-q', '-m', 'main')
+        git(self.repo, 'merge', '-q', '--no-edit', 'side')
+
+        self.assertEqual(get_files_in_commit(str(self.repo), 'HEAD'), ['z.py'])
+
+    def test_head_changes_invalidate_the_cache(self):
+        self.assertEqual(get_current_branch(str(self.repo)), 'main')
+        git(self.repo, 'checkout', '-q', '-b', 'next')
+        self.assertEqual(get_current_branch(str(self.repo)), 'next')
+
+
+if __name__ == '__main__':
+    unittest.main()
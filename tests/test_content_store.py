@@ -0,0 +1,59 @@
+import pathlib
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'plugin'))
+
+from content_store import ContentStore, apply_delta, content_hash, line_delta
+
+
+KEY = ('repo', 'main', 'a.py')
+
+
+class ContentStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = pathlib.Path(self.tmp.name) / 'persisted'
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_put_and_get(self):
+        store = ContentStore(self.directory)
+        self.assertIsNone(store.get(KEY))
+        self.assertIsNone(store.last_hash(KEY))
+
+        store.put(KEY, 'one\ntwo')
+        self.assertEqual(store.get(KEY), (content_hash('one\ntwo'), 'one\ntwo'))
+        self.assertEqual(ContentStore(self.directory).last_hash(KEY), content_hash('one\ntwo'))
+
+    def test_hash_follows_other_processes(self):
+        # Another Vim session, or sync.py, sharing the store directory
+        store = ContentStore(self.directory)
+        other = ContentStore(self.directory)
+
+        store.put(KEY, 'old')
+        self.assertEqual(other.last_hash(KEY), content_hash('old'))
+
+        other.put(KEY, 'new')
+        self.assertEqual(store.last_hash(KEY), content_hash('new'))
+
+        store.put(KEY, 'old')
+        self.assertEqual(other.last_hash(KEY), content_hash('old'))
+
+    def test_hash_of_a_record_created_elsewhere(self):
+        store = ContentStore(self.directory)
+        self.assertIsNone(store.last_hash(KEY))
+
+        ContentStore(self.directory).put(KEY, 'new')
+        self.assertEqual(store.last_hash(KEY), content_hash('new'))
+
+    def test_delta_round_trip(self):
+        base = '\n'.join(f'line {i}' for i in range(100))
+        content = base.replace('line 50', 'line fifty\nand more').replace('line 7\n', '')
+        self.assertEqual(apply_delta(base, line_delta(base, content)), content)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,257 @@
+"""
+Tests the vendored realtime_py client against a local Phoenix channel stand-in on the vendored websockets.server.
+The vendored websockets 8.1 needs Python 3.9 or older, the tests are skipped on anything newer.
+"""
+import asyncio
+import json
+import pathlib
+import sys
+import threading
+import time
+import unittest
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent / 'plugin' / 'vendor'))
+
+import websockets
+
+from realtime_py.connection import Socket
+
+
+class FakePhoenix:
+    """
+    A Phoenix channel server on a background thread, which can be killed and restarted on the same port
+    """
+
+    def __init__(self, answer_heartbeats: bool = True, refuse_joins: bool = False):
+        self.answer_heartbeats = answer_heartbeats
+        self.refuse_joins = refuse_joins
+        self.joins = []
+        self.heartbeats = 0
+        self.port = 0
+
+        self._clients = set()
+        self._server = None
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return f'ws://127.0.0.1:{self.port}/socket/websocket'
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result(5)
+
+    def start(self):
+        async def serve():
+            self._server = await websockets.serve(self._channel, '127.0.0.1', self.port)
+            self.port = self._server.sockets[0].getsockname()[1]
+        self._call(serve())
+        return self
+
+    def kill(self):
+        """
+        Stops listening and drops every connection without a closing handshake, as a crashed server would
+        """
+        async def kill():
+            # Aborted first, closing the server would otherwise wait on a closing handshake with them
+            for ws in list(self._clients):
+                ws.transport.abort()
+            self._server.close()
+            await self._server.wait_closed()
+        self._call(kill())
+
+    def stop(self):
+        self.kill()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def send(self, topic: str, event: str, payload: dict):
+        self.send_raw(json.dumps({'topic': topic, 'event': event, 'ref': None, 'payload': payload}))
+
+    def send_raw(self, frame: str):
+        async def send():
+            for ws in list(self._clients):
+                await ws.send(frame)
+        self._call(send())
+
+    async def _channel(self, ws, path):
+        self._clients.add(ws)
+        try:
+            async for raw in ws:
+                msg = json.loads(raw)
+                status = 'ok'
+                if msg['event'] == 'heartbeat':
+                    self.heartbeats += 1
+                    if not self.answer_heartbeats:
+                        continue
+                elif msg['event'] == 'phx_join':
+                    self.joins.append(msg['topic'])
+                    if self.refuse_joins:
+                        status = 'error'
+                await ws.send(json.dumps({'topic': msg['topic'], 'event': 'phx_reply', 'ref': msg['ref'],
+                                          'payload': {'status': status, 'response': {}}}))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self._clients.discard(ws)
+
+
+async def until(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('timed out')
+        await asyncio.sleep(0.01)
+
+
+@unittest.skipIf(sys.version_info >= (3, 10), 'the vendored websockets 8.1 needs Python 3.9 or older')
+class SocketTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def server(self, **kwargs) -> FakePhoenix:
+        server = FakePhoenix(**kwargs).start()
+        self.servers.append(server)
+        return server
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(asyncio.wait_for(coro, 10))
+
+    def test_rejoins_and_resumes_after_the_server_dies(self):
+        server = self.server()
+        tokens = []
+
+        async def scenario():
+            s = Socket(server.url, hb_interval=60)
+            await s._connect()
+            chan = s.set_channel('docgen:1').on('new_token', tokens.append)
+            listening = asyncio.ensure_future(s._listen())
+            self.assertTrue(await chan._join())
+
+            server.send('docgen:1', 'new_token', {'n': 1})
+            await until(lambda: len(tokens) == 1)
+
+            server.kill()
+            await until(lambda: not s.connected)
+            server.start()
+
+            await until(lambda: server.joins == ['docgen:1', 'docgen:1'])
+            await until(lambda: chan.joined)
+            server.send('docgen:1', 'new_token', {'n': 2})
+            await until(lambda: len(tokens) == 2)
+
+            await s._close()
+            await listening
+
+        self.run_async(scenario())
+        self.assertEqual(tokens, [{'n': 1}, {'n': 2}])
+
+    def test_replies_resolve_the_request_they_answer(self):
+        server = self.server()
+
+        async def scenario():
+            s = Socket(server.url, hb_interval=60)
+            await s._connect()
+            listening = asyncio.ensure_future(s._listen())
+
+            replies = await asyncio.gather(*(s._push(f'topic:{i}', 'phx_join', {}, 5) for i in range(5)))
+            self.assertEqual([reply['status'] for reply in replies], ['ok'] * 5)
+            self.assertEqual(s._replies, {})
+
+            await s._close()
+            await listening
+
+        self.run_async(scenario())
+        self.assertEqual(sorted(server.joins), [f'topic:{i}' for i in range(5)])
+
+    def test_unanswered_heartbeat_aborts_the_connection(self):
+        server = self.server(answer_heartbeats=False)
+
+        async def scenario():
+            s = Socket(server.url, hb_interval=0.1, reconnect=False)
+            await s._connect()
+            keeping_alive = asyncio.ensure_future(s._keep_alive())
+
+            started = time.monotonic()
+            await s._listen()
+            self.assertLess(time.monotonic() - started, 2)
+            self.assertFalse(s.connected)
+
+            s._closing = True
+            await keeping_alive
+
+        self.run_async(scenario())
+        self.assertGreaterEqual(server.heartbeats, 1)
+
+    def test_refused_join_returns_false(self):
+        server = self.server(refuse_joins=True)
+
+        async def scenario():
+            s = Socket(server.url, hb_interval=60)
+            await s._connect()
+            listening = asyncio.ensure_future(s._listen())
+
+            chan = s.set_channel('docgen:1')
+            self.assertFalse(await chan._join())
+            self.assertFalse(chan.joined)
+
+            await s._close()
+            await listening
+
+        self.run_async(scenario())
+
+    def test_malformed_frames_are_skipped(self):
+        server = self.server()
+        tokens = []
+
+        async def scenario():
+            s = Socket(server.url, hb_interval=60)
+            await s._connect()
+            chan = s.set_channel('docgen:1').on('new_token', tokens.append)
+            listening = asyncio.ensure_future(s._listen())
+            self.assertTrue(await chan._join())
+
+            server.send_raw('{not json')
+            server.send_raw('[1, 2]')
+            server.send('docgen:1', 'new_token', {'n': 1})
+            await until(lambda: tokens)
+            self.assertFalse(listening.done())
+
+            await s._close()
+            await listening
+
+        self.run_async(scenario())
+        self.assertEqual(tokens, [{'n': 1}])
+
+    def test_sync_join_before_listen(self):
+        server = self.server()
+        tokens = []
+
+        s = Socket(server.url, hb_interval=60)
+        s.connect()
+        started = time.monotonic()
+        chan = s.set_channel('docgen:1').join().on('new_token', tokens.append)
+        self.assertTrue(chan.joined)
+        self.assertLess(time.monotonic() - started, 2)
+
+        server.send('docgen:1', 'new_token', {'n': 1})
+
+        async def listen():
+            listening = asyncio.ensure_future(s._listen())
+            await until(lambda: tokens)
+            await s._close()
+            await listening
+
+        self.run_async(listen())
+        self.assertEqual(tokens, [{'n': 1}])
+
+
+if __name__ == '__main__':
+    unittest.main()
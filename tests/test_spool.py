@@ -0,0 +1,154 @@
+import multiprocessing
+import pathlib
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'plugin'))
+
+import spool
+from content_store import content_hash
+from spool import Spool
+
+
+def job(name: str, version: int = 0, size: int = 100) -> dict:
+    return {'content': f'{name} v{version} ' + 'x' * size, 'filename': name}
+
+
+def add_and_discard(path: str, name: str):
+    s = Spool(pathlib.Path(path))
+    len(s)
+    for i in range(30):
+        s.add((name, str(i)), job(name, i))
+        if i % 3 == 0:
+            s.discard((name, str(i)))
+
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self.tmp.name) / 'spool.jsonl'
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_keeps_only_the_latest_job_per_key(self):
+        s = Spool(self.path)
+        s.add(('r', 'b', 'a.py'), job('a.py', 0))
+        s.add(('r', 'b', 'b.py'), job('b.py', 0))
+        s.add(('r', 'b', 'a.py'), job('a.py', 1))
+
+        reopened = Spool(self.path)
+        self.assertEqual(reopened.take(10), [
+            (('r', 'b', 'b.py'), job('b.py', 0)),
+            (('r', 'b', 'a.py'), job('a.py', 1)),
+        ])
+
+    def test_discard_only_matching_hash(self):
+        s = Spool(self.path)
+        s.add(('a',), job('a', 1))
+        s.discard(('a',), content_hash(job('a', 0)['content']))
+        self.assertEqual(len(s), 1)
+
+        s.discard(('a',), content_hash(job('a', 1)['content']))
+        self.assertEqual(len(s), 0)
+        self.assertFalse(self.path.exists())
+
+    def test_torn_last_line_is_skipped(self):
+        s = Spool(self.path)
+        s.add(('a',), job('a'))
+        with open(str(self.path), 'ab') as f:
+            f.write(b'{"key": ["b"], "hash": "')
+
+        reopened = Spool(self.path)
+        self.assertEqual([key for key, _ in reopened.take(10)], [('a',)])
+
+        # The next append ends the torn line instead of being glued onto it
+        reopened.add(('c',), job('c'))
+        self.assertEqual([key for key, _ in Spool(self.path).take(10)], [('a',), ('c',)])
+
+    def test_compacts_once_mostly_dead(self):
+        spool.COMPACT_MIN_SIZE, min_size = 0, spool.COMPACT_MIN_SIZE
+        try:
+            s = Spool(self.path)
+            len(s)
+            for version in range(20):
+                s.add(('a',), job('a', version))
+            s.add(('b',), job('b'))
+        finally:
+            spool.COMPACT_MIN_SIZE = min_size
+
+        # 21 lines were appended, compaction keeps the file within twice the two live ones
+        self.assertLessEqual(len(self.path.read_bytes().splitlines()), 4)
+        self.assertEqual(Spool(self.path).take(10), [(('a',), job('a', 19)), (('b',), job('b'))])
+
+    def test_drops_oldest_beyond_max_bytes(self):
+        s = Spool(self.path, max_bytes=2000)
+        len(s)
+        for i in range(20):
+            s.add((str(i),), job(str(i)))
+
+        keys = [key for key, _ in Spool(self.path, max_bytes=2000).take(100)]
+        self.assertLess(len(keys), 20)
+        self.assertEqual(keys, [(str(i),) for i in range(20 - len(keys), 20)])
+        self.assertLessEqual(self.path.stat().st_size, 2 * 2000)
+
+    def test_bound_applies_to_appends_from_an_unread_spool(self):
+        s = Spool(self.path, max_bytes=2000)
+        for i in range(20):
+            s.add((str(i),), job(str(i)))
+
+        self.assertLessEqual(len(Spool(self.path, max_bytes=2000)), 20 * 3 // 4)
+
+    def test_sessions_sharing_the_file_keep_each_others_entries(self):
+        a = Spool(self.path)
+        a.add(('a',), job('a'))
+        self.assertEqual(len(a), 1)
+
+        b = Spool(self.path)
+        b.add(('b',), job('b'))
+
+        # A's index didn't have B's entry, which must survive A emptying its own
+        a.discard(('a',))
+        self.assertEqual([key for key, _ in Spool(self.path).take(10)], [('b',)])
+        self.assertEqual([key for key, _ in b.take(10)], [('b',)])
+
+    def test_offsets_follow_a_file_replaced_by_another_session(self):
+        spool.COMPACT_MIN_SIZE, min_size = 0, spool.COMPACT_MIN_SIZE
+        try:
+            a = Spool(self.path)
+            b = Spool(self.path)
+            a.add(('a',), job('a'))
+            self.assertEqual(len(a), 1)
+            self.assertEqual(len(b), 1)
+            header = self.path.read_bytes().split(b'\n')[0]
+
+            # Compacts, replacing the file under B
+            for version in range(1, 10):
+                a.add(('a',), job('a', version))
+            self.assertNotEqual(self.path.read_bytes().split(b'\n')[0], header)
+            b.add(('b',), job('b'))
+        finally:
+            spool.COMPACT_MIN_SIZE = min_size
+
+        self.assertEqual(b.take(10), [(('a',), job('a', 9)), (('b',), job('b'))])
+        self.assertEqual(a.take(10), [(('a',), job('a', 9)), (('b',), job('b'))])
+
+    def test_concurrent_processes(self):
+        spool.COMPACT_MIN_SIZE, min_size = 0, spool.COMPACT_MIN_SIZE
+        try:
+            processes = [multiprocessing.Process(target=add_and_discard, args=(str(self.path), name)) for name in 'abc']
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+                self.assertEqual(process.exitcode, 0)
+        finally:
+            spool.COMPACT_MIN_SIZE = min_size
+
+        self.assertEqual(sorted(key for key, _ in Spool(self.path).take(100)),
+                         sorted((name, str(i)) for name in 'abc' for i in range(30) if i % 3))
+
+
+if __name__ == '__main__':
+    unittest.main()